@@ -0,0 +1,163 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import data_loader
+import metrics
+
+## Finest grain every AE table is rolled up from, one row per subject within each combination
+KEYS=['TRTA','AEBODSYS','AEOUT','AESEV','AEREL','AESHOSP','USUBJID']
+
+## Group columns and count column name of each table
+TABLES={'occurrences':(['TRTA','AEBODSYS'],'Occurrences'),
+        'hospitalisation':(['TRTA','AESHOSP'],'Subject Count'),
+        'severity':(['TRTA','AESEV'],'USUBJID'),
+        'outcome_all':(['AEBODSYS','AEOUT'],'USUBJID'),
+        'outcome':(['TRTA','AEBODSYS','AEOUT'],'USUBJID'),
+        'causality':(['TRTA','AEREL'],'USUBJID')}
+
+## Per-treatment table each table without TRTA is summed from, e.g. outcome for outcome_all
+POOLED={name:source for name,(keys,_) in TABLES.items() if 'TRTA' not in keys
+        for source,(source_keys,_) in TABLES.items() if source_keys==['TRTA']+keys}
+
+## Counting modes, 'events' counts AE records and 'subjects' counts each subject once per group
+BASES=('events','subjects')
+
+MAX_SUMMARIES=16
+
+_summaries=OrderedDict()
+_lock=threading.Lock()
+
+
+## The single pass over ADAE: event count and ADURN sum/count per subject and key combination
+def build_events(data):
+    return data.groupby(by=KEYS,observed=True,dropna=False).agg(EVENTS=('ADURN','size'),ADURN_SUM=('ADURN','sum'),ADURN_N=('ADURN','count')).reset_index()
+
+
+## Adds the event rows of two builds, subjects are part of the keys so counts and ADURN sums simply add up
+def merge_events(events,other):
+    merged=data_loader.concat([events,other])
+    return merged.groupby(by=KEYS,observed=True,dropna=False).sum().reset_index()
+
+
+def count_table(events,keys,name,basis):
+    grouped=events.groupby(by=keys,observed=True)
+    counts=grouped['EVENTS'].sum() if basis=='events' else grouped['USUBJID'].nunique()
+    return counts.rename(name).reset_index()
+
+
+def duration_table(events):
+    grouped=events.groupby(by=['TRTA','AEBODSYS'],observed=True)[['ADURN_SUM','ADURN_N']].sum()
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mean=(grouped['ADURN_SUM']/grouped['ADURN_N']).where(grouped['ADURN_N']>0)
+    return mean.rename('ADURN').reset_index()
+
+
+## Every table rolled up from `events`, with `by_treatment` only those split by treatment
+def roll_up(events,by_treatment=False):
+    tables={('duration',None):duration_table(events)}
+    for basis in BASES:
+        for name,(keys,count_name) in TABLES.items():
+            if by_treatment and name in POOLED:
+                continue
+            table=count_table(events,keys,count_name,basis)
+            if name=='hospitalisation':
+                table=table[table['AESHOSP']=='Y'].reset_index(drop=True)
+            tables[(name,basis)]=table
+    return tables
+
+
+## Rows of every table with a TRTA column per treatment of `groups`, empty tables where a treatment has no rows
+def split_tables(tables,groups):
+    out={group:{} for group in groups}
+    for key,table in tables.items():
+        if 'TRTA' not in table.columns:
+            continue
+        frames={group:frame.reset_index(drop=True) for group,frame in table.groupby('TRTA',observed=True)}
+        for group in groups:
+            out[group][key]=frames.get(group,table.iloc[:0])
+    return out
+
+
+class AESummary:
+
+    ## Summary of `data` at dataset `version`. Event rows and tables are also kept per treatment, with `previous`, `data`
+    ## only holds the records appended since that summary and only the treatments it touches are merged and rolled up again.
+    ## The all-treatment tables are then put together from the per-treatment ones.
+    def __init__(self,data,version=None,previous=None):
+        self.version=version
+        events=build_events(data)
+        touched={group:frame.reset_index(drop=True) for group,frame in events.groupby('TRTA',observed=True)}
+        if previous is None:
+            self.events=touched
+            self.versions={group:version for group in touched}
+            self.tables=roll_up(events)
+            self.by_treatment=split_tables(self.tables,touched)
+            self.subjects={group:set(frame['USUBJID'].unique()) for group,frame in touched.items()}
+            ## Whether a subject has events under more than one treatment, the subject counts of pooled tables then do not add up
+            self.overlap=sum(map(len,self.subjects.values()))>len(set().union(*self.subjects.values()))
+            return
+        self.events,self.versions=dict(previous.events),dict(previous.versions)
+        self.by_treatment,self.subjects,self.overlap=dict(previous.by_treatment),dict(previous.subjects),previous.overlap
+        self.tables=previous.tables
+        if not touched:
+            return
+        for group,frame in touched.items():
+            if group in self.events:
+                frame=merge_events(self.events[group],frame)
+            self.events[group]=frame
+            self.by_treatment[group]=roll_up(frame,by_treatment=True)
+            self.subjects[group]=set(frame['USUBJID'].unique())
+            self.versions[group]=version
+            self.overlap=self.overlap or any(not self.subjects[group].isdisjoint(subjects) for other,subjects in self.subjects.items() if other!=group)
+        ## Treatments in the order groupby puts them, the appended records carry the categories of the whole frame
+        trta=data['TRTA'].dtype
+        groups=sorted(self.events,key=list(trta.categories).index if isinstance(trta,pd.CategoricalDtype) else None)
+        self.tables={key:data_loader.concat([self.by_treatment[group][key] for group in groups]) for key in self.by_treatment[groups[0]]}
+        for name,source in POOLED.items():
+            keys,count_name=TABLES[name]
+            for basis in BASES:
+                if basis=='events' or not self.overlap:
+                    table=self.tables[(source,basis)].groupby(by=keys,observed=True)[TABLES[source][1]].sum().rename(count_name).reset_index()
+                else:
+                    table=count_table(data_loader.concat([self.events[group] for group in groups]),keys,count_name,basis)
+                self.tables[(name,basis)]=table
+
+    ## Table `name` for all treatments, or only the rows of treatment `group`
+    def table(self,name,group=None,basis='events'):
+        key=(name,None if name=='duration' else basis)
+        if group is None:
+            return self.tables[key]
+        tables=self.by_treatment.get(group)
+        if tables is None:
+            return self.tables[key].iloc[:0]
+        return tables[key]
+
+    ## Copy with the count tables but without the per-subject event rows, small enough to send to a worker process
+    def subset(self):
+        part=AESummary.__new__(AESummary)
+        part.version,part.versions,part.overlap=self.version,self.versions,self.overlap
+        part.events,part.subjects={},{}
+        part.tables,part.by_treatment=self.tables,self.by_treatment
+        return part
+
+    ## Dataset version in which the rows of treatment `group` last changed, the all-treatment views change with every version
+    def group_version(self,group=None):
+        return self.version if group is None else self.versions.get(group,self.version)
+
+
+## Returns the summary for a dataset version, building it only the first time the version is seen.
+## A version produced by appending records to a known one is updated from that summary with only the new rows.
+def get(data,version):
+    with _lock,metrics.timed('aggregate','ae'):
+        summary=_summaries.get(version)
+        if summary is None:
+            parent,delta=data_loader.appended_since('adae',version,_summaries)
+            summary=AESummary(delta,version,_summaries[parent]) if parent else AESummary(data,version)
+            _summaries[version]=summary
+            while len(_summaries)>MAX_SUMMARIES:
+                _summaries.popitem(last=False)
+        _summaries.move_to_end(version)
+        return summary
@@ -0,0 +1,221 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+from urllib.parse import parse_qs,urlsplit
+
+import pandas as pd
+
+import ae_summary
+import data_loader
+import lab_summary
+import metrics
+
+logger=logging.getLogger(__name__)
+
+## Seconds between checks for new data, requests never read the parquet files themselves
+REFRESH_SECONDS=float(os.environ.get('DASHBOARD_API_REFRESH','30'))
+
+## Encoded responses kept per query, keyed by dataset version so new data never serves a stale body
+MAX_RESPONSES=int(os.environ.get('DASHBOARD_API_RESPONSES','4096'))
+
+## Lab metrics are the tables behind the Laboratory charts, with the description served on /
+LAB_METRICS={'pre_post':'mean AVAL per treatment and analysis visit (AVISIT), the pre_post chart',
+             'trend':'mean and SD of AVAL per treatment and visit, the param_trend chart',
+             'abs_change':'mean and SD of the absolute change from baseline per treatment and visit, the line_with_range chart',
+             'pct_change':'mean and SD of the percent change from baseline per treatment and visit, the line_with_range chart',
+             'abs_change_post':'abs_change of the post-baseline records (ABLFL N), the line_with_sd chart',
+             'pct_change_post':'pct_change of the post-baseline records (ABLFL N), the line_with_sd chart',
+             'lab_indicator':'subjects per treatment, analysis visit and LBNRIND, the faceted_trend chart'}
+
+## Change metrics leave out the screening visit like line_with_range and line_with_sd do
+SCREENING_DROPPED=('abs_change','pct_change','abs_change_post','pct_change_post')
+
+
+class QueryError(Exception):
+    pass
+
+
+## Lab and AE summaries of every study, swapped as a whole by `refresh` when a dataset version changes
+class QueryIndex:
+
+    def __init__(self):
+        self.summaries={}
+        self.versions={}
+        self._responses=OrderedDict()
+        self._lock=threading.Lock()
+
+    def studies(self):
+        return data_loader.studies() if data_loader.partitioned('adlb') else [None]
+
+    ## Loads the datasets of every study and builds the summaries of any version not indexed yet
+    def refresh(self):
+        summaries,versions={},{}
+        for study in self.studies():
+            df_adlb,adlb_version=data_loader.select('adlb',study=study)
+            df_adae,adae_version=data_loader.select('adae',study=study)
+            summaries[study]=(lab_summary.get(df_adlb,adlb_version),ae_summary.get(df_adae,adae_version))
+            versions[study]=f'{adlb_version}-{adae_version}'
+        with self._lock:
+            changed=versions!=self.versions
+            self.summaries,self.versions=summaries,versions
+        if changed:
+            logger.info('Query index at versions %s',versions)
+
+    def _summary(self,study):
+        with self._lock:
+            if study not in self.summaries:
+                raise QueryError(f'unknown study {study!r}, one of {sorted(self.summaries,key=str)}')
+            return self.summaries[study],self.versions[study]
+
+    ## (ETag, JSON body) of one query, encoded once per dataset version
+    def response(self,endpoint,query):
+        study=query.get('study',next(iter(self.summaries)))
+        summary,version=self._summary(study)
+        key=(endpoint,version)+tuple(sorted(query.items()))
+        with self._lock:
+            cached=self._responses.get(key)
+            if cached is not None:
+                self._responses.move_to_end(key)
+                return cached
+        if endpoint=='/lab':
+            frame=self.lab(summary[0],query)
+        elif endpoint=='/ae':
+            frame=self.ae(summary[1],query)
+        else:
+            frame=None
+        if frame is None:
+            body=json.dumps(self.describe(summary,version)).encode()
+        else:
+            body=f'{{"version":"{version}","rows":{frame.to_json(orient="records")}}}'.encode()
+        cached=(f'"{hashlib.sha256(body).hexdigest()[:16]}"',body)
+        with self._lock:
+            self._responses[key]=cached
+            while len(self._responses)>MAX_RESPONSES:
+                self._responses.popitem(last=False)
+        return cached
+
+    ## Rows of lab metric `metric` filtered by param (PARAMCD), treatment (TRTA) and visit (VISIT or AVISIT)
+    def lab(self,lab,query):
+        metric=query.get('metric','trend')
+        if metric not in LAB_METRICS:
+            raise QueryError(f'unknown metric {metric!r}, one of {list(LAB_METRICS)}')
+        params=[query['param']] if 'param' in query else sorted(lab.views)
+        frame=pd.concat([lab.view(param,metric) for param in params],ignore_index=True) if params else lab.view(None,metric)
+        if metric in SCREENING_DROPPED:
+            frame=frame[frame['VISIT']!='SCREENING 1']
+        if 'treatment' in query:
+            frame=frame[frame['TRTA']==query['treatment']]
+        if 'visit' in query:
+            frame=frame[frame['VISIT' if 'VISIT' in frame.columns else 'AVISIT']==query['visit']]
+        return frame
+
+    ## Rows of AE table `table` for one count basis, all treatments or only `treatment`
+    def ae(self,ae,query):
+        name=query.get('table','occurrences')
+        basis=query.get('basis','events')
+        if name!='duration' and name not in ae_summary.TABLES:
+            raise QueryError(f'unknown table {name!r}, one of {["duration"]+list(ae_summary.TABLES)}')
+        if basis not in ae_summary.BASES:
+            raise QueryError(f'unknown basis {basis!r}, one of {list(ae_summary.BASES)}')
+        if 'treatment' in query and name!='duration' and 'TRTA' not in ae_summary.TABLES[name][0]:
+            raise QueryError(f'table {name!r} pools all treatments, it takes no treatment')
+        return ae.table(name,query.get('treatment'),basis)
+
+    ## What can be queried, served on /
+    def describe(self,summary,version):
+        lab,ae=summary
+        return {'version':version,'studies':[s for s in self.versions if s is not None],
+                'lab':{'metrics':LAB_METRICS,'params':sorted(lab.views)},
+                'ae':{'tables':['duration']+list(ae_summary.TABLES),'bases':list(ae_summary.BASES),
+                      'treatments':sorted(str(g) for g in ae.versions)}}
+
+
+index=QueryIndex()
+
+
+class Handler(BaseHTTPRequestHandler):
+    ## Keeps connections open between requests, every response carries a Content-Length
+    protocol_version='HTTP/1.1'
+    ## Headers and body are written separately, with Nagle's algorithm each reused-connection response waits for a delayed ACK
+    disable_nagle_algorithm=True
+
+    def _send(self,status,body=b'',content_type='application/json',etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag',etag)
+            self.send_header('Cache-Control','no-cache')
+        if status!=304:
+            self.send_header('Content-Type',content_type)
+            self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        if body and self.command!='HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url=urlsplit(self.path)
+        query={key:values[-1] for key,values in parse_qs(url.query).items()}
+        if url.path=='/metrics':
+            self._send(200,metrics.prometheus().encode(),'text/plain; version=0.0.4')
+            return
+        if url.path not in ('/','/lab','/ae'):
+            self._send(404,json.dumps({'error':f'unknown path {url.path}'}).encode())
+            return
+        with metrics.timed('query',url.path):
+            try:
+                etag,body=index.response(url.path,query)
+            except QueryError as exc:
+                self._send(400,json.dumps({'error':str(exc)}).encode())
+                return
+            ## Any other failure still gets a response, a keep-alive client would otherwise wait on a dropped connection
+            except Exception:
+                logger.exception('Query %s failed',self.path)
+                self._send(500,json.dumps({'error':'internal error'}).encode())
+                return
+        ## Conditional request, the client already holds this exact body
+        if_none_match=self.headers.get('If-None-Match','')
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip()=='*':
+            self._send(304,etag=etag)
+        else:
+            self._send(200,body,etag=etag)
+
+    do_HEAD=do_GET
+
+    def log_message(self,format,*args):
+        logger.debug(format,*args)
+
+
+def _refresh_loop(stop):
+    while not stop.wait(REFRESH_SECONDS):
+        try:
+            index.refresh()
+        except Exception:
+            logger.exception('Query index refresh failed')
+
+
+## Builds the index, then serves it until interrupted, re-checking the datasets every REFRESH_SECONDS
+def serve(host,port):
+    index.refresh()
+    stop=threading.Event()
+    threading.Thread(target=_refresh_loop,args=(stop,),name='api-refresh',daemon=True).start()
+    server=ThreadingHTTPServer((host,port),Handler)
+    server.daemon_threads=True
+    logger.info('Serving the dashboard summaries on http://%s:%d',host,port)
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        server.server_close()
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Serve the lab and AE summaries of the dashboard as JSON over HTTP.')
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8502)
+    args=parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve(args.host,args.port)
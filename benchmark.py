@@ -0,0 +1,157 @@
+import argparse
+import json
+import math
+import time
+import tracemalloc
+
+import pandas as pd
+
+import ae_summary
+import charts
+import data_loader
+import lab_summary
+
+## Subject identifier columns made unique in each copy of a synthetic dataset
+SUBJECT_COLUMNS={'adsl':['USUBJID','SUBJID'],'adlb':['USUBJID'],'adae':['USUBJID']}
+
+
+## Synthetic study `factor` times the size of `data`, every copy gets its own subjects
+def scale(data,domain,factor):
+    if factor==1:
+        return data
+    copies=[]
+    for i in range(factor):
+        copy=data.copy()
+        for col in SUBJECT_COLUMNS[domain]:
+            if col not in copy.columns:
+                continue
+            if pd.api.types.is_numeric_dtype(copy[col]):
+                ## normalize() stores small IDs in narrow integer types, the offsets need the full width
+                copy[col]=copy[col].astype('int64')+i*10**7
+            else:
+                copy[col]=copy[col].astype(str)+f'-{i}'
+        copies.append(copy)
+    return data_loader.normalize(pd.concat(copies,ignore_index=True))
+
+
+def datasets(factor):
+    data={}
+    for domain in data_loader.FILES:
+        data[domain]=scale(data_loader.load(domain)[0],domain,factor)
+    return data
+
+
+## (name, callable) of every aggregation and chart builder the dashboard runs, for one parameter and treatment
+def cases(data,param,group):
+    adsl,adlb,adae=data['adsl'],data['adlb'],data['adae']
+    lab=lab_summary.LabSummary(adlb)
+    ae=ae_summary.AESummary(adae)
+    return [('lab_summary',lambda: lab_summary.LabSummary(adlb)),
+            ('ae_summary',lambda: ae_summary.AESummary(adae)),
+            ('create_disposition_donut_plot',lambda: charts.create_disposition_donut_plot(adsl,'RACE',group)),
+            ('create_distribution_plot',lambda: charts.create_distribution_plot(adsl,'BMIBL',group)),
+            ('create_subject_count_bar_plot',lambda: charts.create_subject_count_bar_plot(adsl,group)),
+            ('pre_post',lambda: charts.pre_post(lab,param)),
+            ('param_trend',lambda: charts.param_trend(lab,param)),
+            ('line_with_range_abs',lambda: charts.line_with_range(lab,param,2)),
+            ('line_with_range_pct',lambda: charts.line_with_range(lab,param,3)),
+            ('line_with_sd_abs',lambda: charts.line_with_sd(lab,param,2,group)),
+            ('line_with_sd_pct',lambda: charts.line_with_sd(lab,param,3,group)),
+            ('faceted_trend',lambda: charts.faceted_trend(lab,param,group)),
+            ('box_treatment',lambda: charts.box_treatment(adlb,param,group)),
+            ('box_treatment_summary',lambda: charts.box_treatment_summary(adlb,param,group)),
+            ('ae_mean_duration',lambda: charts.ae_mean_duration(ae,None)),
+            ('ae_occurrences',lambda: charts.ae_occurrences(ae,None)),
+            ('ae_outcome',lambda: charts.ae_outcome(ae,None)),
+            ('ae_hospitalisation',lambda: charts.ae_hospitalisation(ae)),
+            ('ae_severity',lambda: charts.ae_severity(ae,None)),
+            ('ae_causality',lambda: charts.ae_causality(ae,None))]
+
+
+## Per-visit box of plotly.js (traces/box/calc.js) for sorted `values`: linear quartiles, whiskers and outliers
+def plotly_box(values):
+    def interp(p):
+        rank=p*len(values)-0.5
+        if rank<0:
+            return values[0]
+        if rank>len(values)-1:
+            return values[-1]
+        frac=rank%1
+        return frac*values[math.ceil(rank)]+(1-frac)*values[math.floor(rank)]
+    q1,median,q3=interp(0.25),interp(0.5),interp(0.75)
+    lo,hi=2.5*q1-1.5*q3,2.5*q3-1.5*q1
+    lf=min([q1]+[v for v in values if v>=lo][:1])
+    uf=max([q3]+[v for v in values if v<=hi][-1:])
+    return {'Q1':q1,'MEDIAN':median,'Q3':q3,'LOWERFENCE':lf,'UPPERFENCE':uf,'outliers':sum(v<lf or v>uf for v in values)}
+
+
+## Visit boxes where charts.box_statistics differs from plotly's own computation, for every parameter and treatment
+def check_boxes(adlb):
+    mismatches=[]
+    for (param,group),data in adlb[adlb['AVAL'].notna()].groupby(['PARAMCD','TRTA'],observed=True):
+        stats,outliers=charts.box_statistics(data,max_outliers=len(data))
+        counts=outliers.groupby('VISIT',observed=True).size()
+        for row in stats.itertuples():
+            expected=plotly_box(sorted(data.loc[data['VISIT']==row.VISIT,'AVAL'].astype('float64')))
+            got={key:getattr(row,key) for key in ('Q1','MEDIAN','Q3','LOWERFENCE','UPPERFENCE')}
+            got['outliers']=int(counts.get(row.VISIT,0))
+            if any(not math.isclose(got[key],expected[key],rel_tol=1e-9,abs_tol=1e-12) for key in expected):
+                mismatches.append({'param':param,'treatment':group,'visit':row.VISIT,'expected':expected,'got':got})
+    return mismatches
+
+
+## Best wall time of `repeat` runs (build plus JSON serialization for figures), peak traced memory and JSON size
+def measure(func,repeat):
+    best=None
+    for _ in range(repeat):
+        start=time.perf_counter()
+        result=func()
+        fig_json=result.to_json() if hasattr(result,'to_json') else None
+        elapsed=time.perf_counter()-start
+        best=elapsed if best is None else min(best,elapsed)
+    tracemalloc.start()
+    func()
+    _,peak=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds':best,'peak_mb':peak/2**20,'json_kb':len(fig_json)/1024 if fig_json is not None else None}
+
+
+def run(scales,repeat,param,group,only=None):
+    results=[]
+    for factor in scales:
+        data=datasets(factor)
+        rows=len(data['adlb'])
+        for name,func in cases(data,param,group):
+            if only and name not in only:
+                continue
+            result=measure(func,repeat)
+            result.update(builder=name,scale=factor,adlb_rows=rows)
+            results.append(result)
+            size='-' if result['json_kb'] is None else f"{result['json_kb']:.1f} KB"
+            print(f"{factor:>6}x {name:<32} {result['seconds']*1000:>10.1f} ms {result['peak_mb']:>9.1f} MB {size:>13}",flush=True)
+    return results
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Time the dashboard aggregations and chart builders without a browser.')
+    parser.add_argument('--scales',type=int,nargs='+',default=[1,10,100],
+                        help='sizes of the synthetic studies as multiples of the bundled data, 1 is the bundled data itself')
+    parser.add_argument('--repeat',type=int,default=3,help='timed runs per builder, the best one is reported')
+    parser.add_argument('--param',default='HGB',help='PARAMCD used by the lab builders')
+    parser.add_argument('--treatment',default='Placebo',help='treatment used by the per-arm builders')
+    parser.add_argument('--only',nargs='+',help='names of the builders to run')
+    parser.add_argument('--json',help='also write the results to this file')
+    parser.add_argument('--check-boxes',action='store_true',
+                        help='only compare the summary box plots with plotly\'s own quartiles and whiskers on the bundled data')
+    args=parser.parse_args()
+    if args.check_boxes:
+        mismatches=check_boxes(data_loader.load('adlb')[0])
+        for mismatch in mismatches:
+            print(mismatch)
+        print(f'{len(mismatches)} visit boxes differ from plotly')
+        raise SystemExit(1 if mismatches else 0)
+    print(f"{'scale':>7} {'builder':<32} {'wall time':>13} {'peak memory':>12} {'figure JSON':>13}")
+    results=run(args.scales,args.repeat,args.param,args.treatment,args.only)
+    if args.json:
+        with open(args.json,'w') as f:
+            json.dump(results,f,indent=2)
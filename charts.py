@@ -0,0 +1,307 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objs as go
+
+from ae_summary import AESummary
+from figure_cache import cache
+from lab_summary import LabSummary
+
+param_dict={'Hemoglobin (mmol/L)':'HGB', 'Hematocrit':'HCT',
+   'Ery. Mean Corpuscular Volume (fL)':'MCV',
+   'Ery. Mean Corpuscular Hemoglobin (fmol(Fe))':'MCH',
+   'Ery. Mean Corpuscular HGB Concentration (mmol/L)':'MCHC',
+   'Leukocytes (GI/L)':'WBC', 'Lymphocytes (GI/L)':'LYM', 'Monocytes (GI/L)':'MONO',
+   'Eosinophils (GI/L)':'EOS', 'Basophils (GI/L)':'BASO', 'Platelet (GI/L)':'PLAT',
+   'Erythrocytes (TI/L)':'RBC'}
+
+## Returns the figure of `builder` from the shared figure cache, building it only on a miss.
+## `data` is the frame or lab summary of dataset `version`; every other argument (parameter, plot type,
+## treatment arm...) must be hashable and becomes part of the cache key.
+def cached_figure(builder,version,data,*args):
+    key=(builder.__name__,version)+args
+    return cache.get_or_build(key,lambda: builder(data,*args),builder.__name__)
+
+
+## Figures of several (builder, version, data, *args) jobs in job order, built in parallel when figure_cache.WORKERS is set.
+## Builders and their data are sent to the worker processes, so both must be picklable.
+def cached_figures(*jobs):
+    return cache.get_or_build_many([((builder.__name__,version)+tuple(args),builder,(data,)+tuple(args),builder.__name__)
+                                    for builder,version,data,*args in jobs],worker_args)
+
+
+## The part of a job's data its builder reads, a worker is sent one parameter's views or one arm's rows
+## instead of the whole summary or ADLB frame
+def worker_args(builder,args):
+    data,*rest=args
+    if isinstance(data,LabSummary):
+        data=data.subset(rest[0])
+    elif isinstance(data,AESummary):
+        data=data.subset()
+    elif builder in (box_treatment,box_treatment_summary):
+        param,group=rest
+        data=data[(data['TRTA']==group) & (data['PARAMCD']==param)]
+    return (data,*rest)
+
+
+def param_label(param):
+    return list(param_dict.keys())[list(param_dict.values()).index(param)]
+
+
+## ADSL
+
+def create_disposition_donut_plot(data,variable,group):
+    filtered_data = data[data['ARM'] == group]
+    fig = px.pie(filtered_data, names=variable, hole=0.5,
+                title=f'Summary in {group} Group')
+    fig.update_traces( hovertemplate=
+'<b>%{label}:</b><br>' +
+'Count: %{value:.3g}<br>' +
+'Percentage: %{percent:.2%}')
+    return fig
+
+def create_distribution_plot(data,parameter,group):
+    par_dict={'BMIBL':'Body Mass Index','WEIGHTBL':'Weight','HEIGHTBL':'Height'}
+    filtered_data = data[data['ARM'] == group]
+    fig = px.box(filtered_data, x='SEX', y=parameter,
+                title=f'{par_dict[parameter]} Distribution by Gender in {group} Group',category_orders={'SEX':['M','F']})
+    fig.update_layout(yaxis_title=par_dict[parameter])
+    return fig
+
+def create_subject_count_bar_plot(data,group):
+    filtered_data = data[data['ARM'] == group]
+    subject_count = filtered_data.groupby(by=['AGEGR1','SEX'],observed=True)['SUBJID'].nunique().reset_index()
+    fig = px.bar(subject_count, x='AGEGR1', y='SUBJID', color='SEX',barmode='group',title=f'Number of Subjects by AGE Group in {group} Group')
+    fig.update_layout(xaxis_title='Age Group', yaxis_title='Number of Subjects')
+    fig.update_traces(hovertemplate=
+'<b>Age Group:</b> %{x}<br>' +
+'<b>Subject Count:</b> %{y:.3g}<br>')
+    return fig
+
+
+## Laboratory, the `lab` argument is a lab_summary.LabSummary
+
+##Function to create a bar group to compare means of Parameters pre-Post treatment
+def pre_post(lab,param):
+    par=param_label(param)
+    data=lab.view(param,'pre_post')
+    filtered_data=data.rename(columns={'TRTA':'Treatment','AVISIT':'Analysis Visit','AVAL':'Mean'})
+    fig=px.bar(filtered_data[((filtered_data['Analysis Visit']=='Baseline') | (filtered_data['Analysis Visit']=='End of Treatment')) & (filtered_data['PARAMCD']==param)],
+                x='Treatment',y='Mean',color='Analysis Visit',barmode='group',
+                title=f'Pre-Post Treatment per Treatment Group for Parameter {par}',
+                hover_data={'Treatment':True,'Analysis Visit':True,'Mean':':.3g'})
+    fig.update_layout(yaxis_title=f'{par}',xaxis_title='Treatment')
+    return fig
+
+
+##Function to create a line chart and compare treatments with their means per parameter
+def param_trend(lab,param):
+    par=param_label(param)
+    data=lab.view(param,'trend')
+    filtered_data=data
+    filtered_data = filtered_data.rename(columns={'VISIT': 'Visit','AVAL': 'Mean','TRTA': 'Treatment','ASTD': 'Standard Deviation'})
+    fig=px.line(filtered_data[filtered_data['PARAMCD']==param],
+            x='Visit',y='Mean',color='Treatment',title=f'Mean {par} Value across VISITS',hover_data={'Visit':True,'Mean':':.3g','Treatment':True,'Standard Deviation':':.3g'})
+    fig.update_layout(yaxis_title=f'{par}')
+    return fig
+
+
+##To create a Box plot to understand the distribution of parameters value per treatment across weeks, `data` is the raw ADLB frame
+def box_treatment(data,param,group):
+    par=param_label(param)
+    filtered_data=data[(data['TRTA']==group) & (data['PARAMCD']==param)]
+    filtered_data=filtered_data.rename(columns={'VISIT':'Visit','AVAL':'Value','LBNRIND':'Lab Indicator','USUBJID':'Subject ID'})
+    fig=px.box(filtered_data,
+            x='Visit',y='Value',
+            title=f'Distribution of Paramter {par} for Treatment Group {group}',
+            hover_data={'Visit':True,'Value':':.3g','Lab Indicator':True,'Subject ID':True})
+    fig.update_layout(xaxis_title='VISIT',yaxis_title=f'{par}')
+    return fig
+
+## Most extreme points kept per visit when the box plot is drawn from precomputed statistics
+MAX_OUTLIERS=50
+
+## Quantile `p` of the sorted values of each group, interpolated like plotly's default 'linear' quartile method:
+## at rank p*n-0.5, clamped to the first and last value (numpy's 'hazen'). pandas interpolates at (n-1)*p instead.
+def plotly_quantile(values,starts,counts,p):
+    rank=np.clip(p*counts-0.5,0,counts-1)
+    lower=np.floor(rank).astype(int)
+    upper=np.ceil(rank).astype(int)
+    frac=rank-lower
+    return (1-frac)*values[starts+lower]+frac*values[starts+upper]
+
+## Quartiles, whiskers and outliers of AVAL per visit, computed the same way plotly does (linear quartiles, 1.5 IQR fences)
+def box_statistics(data,max_outliers=MAX_OUTLIERS):
+    data=data[data['AVAL'].notna()]
+    ordered=data.sort_values(['VISIT','AVAL'])
+    values=ordered['AVAL'].to_numpy(dtype='float64')
+    counts=ordered.groupby(by='VISIT',observed=True,sort=True)['AVAL'].size()
+    starts=np.concatenate([[0],np.cumsum(counts.to_numpy())[:-1]]).astype(int)
+    n=counts.to_numpy()
+    stats=pd.DataFrame({name:plotly_quantile(values,starts,n,p) for name,p in (('Q1',0.25),('MEDIAN',0.5),('Q3',0.75))},index=counts.index)
+    ## Fences as plotly writes them, the whiskers end at the outermost values inside and never inside the box
+    stats['LO']=2.5*stats['Q1']-1.5*stats['Q3']
+    stats['HI']=2.5*stats['Q3']-1.5*stats['Q1']
+    bounds=stats.loc[data['VISIT'],['LO','HI','MEDIAN']].to_numpy()
+    inside=(data['AVAL'].to_numpy()>=bounds[:,0]) & (data['AVAL'].to_numpy()<=bounds[:,1])
+    fences=data[inside].groupby(by='VISIT',observed=True)['AVAL'].agg(['min','max'])
+    stats['LOWERFENCE']=np.fmin(stats['Q1'],fences['min'])
+    stats['UPPERFENCE']=np.fmax(stats['Q3'],fences['max'])
+    outliers=data[~inside].assign(DISTANCE=abs(data['AVAL'].to_numpy()-bounds[:,2])[~inside])
+    outliers=outliers.sort_values('DISTANCE',ascending=False).groupby(by='VISIT',observed=True).head(max_outliers)
+    return stats.reset_index(),outliers.drop(columns='DISTANCE')
+
+## Box plot drawn from box_statistics, ships a handful of numbers per visit instead of every AVAL row
+def box_treatment_summary(data,param,group):
+    par=param_label(param)
+    stats,outliers=box_statistics(data[(data['TRTA']==group) & (data['PARAMCD']==param)])
+    visits=stats['VISIT'].astype(str)
+    fig=go.Figure([go.Box(name='Value',x=visits,q1=stats['Q1'],median=stats['MEDIAN'],q3=stats['Q3'],
+                          lowerfence=stats['LOWERFENCE'],upperfence=stats['UPPERFENCE'],
+                          boxpoints=False,marker=dict(color='#636efa'),showlegend=False),
+                   go.Scatter(name='Outliers',x=outliers['VISIT'].astype(str),y=outliers['AVAL'],mode='markers',
+                              marker=dict(color='#636efa'),showlegend=False,customdata=outliers[['LBNRIND','USUBJID']].astype(str),
+                              hovertemplate=('Visit=%{x}<br>Value=%{y:.3g}<br>Lab Indicator=%{customdata[0]}<br>Subject ID=%{customdata[1]}<extra></extra>'))])
+    fig.update_layout(title=f'Distribution of Paramter {par} for Treatment Group {group}',xaxis_title='VISIT',yaxis_title=f'{par}')
+    fig.update_xaxes(categoryorder='array',categoryarray=visits)
+    return fig
+
+## To create a line chart with SD for the values of Absolute Change and Percentage Change
+def line_with_range(lab,param,abs):
+    par=param_label(param)
+    if abs==2:
+        data=lab.view(param,'abs_change')
+        data=data[data['VISIT']!='SCREENING 1']
+        filtered_data=data[(data['PARAMCD']==param)]
+        filtered_data=filtered_data.rename(columns={'TRTA':'Treatment','VISIT':'Visit','ABSVAL':'Mean','ABSSTD':'Standard Deviation'})
+        fig=px.line(filtered_data,x='Visit',y='Mean',color='Treatment',hover_data={'Treatment':True,'Visit':True,'Mean':':.3g','Standard Deviation':':.3g'})
+        fig.update_layout(title=f'Absolute Change for {par}',xaxis_title='Visit',yaxis_title='Absolute Change')
+        return fig
+    elif abs==3:
+        data=lab.view(param,'pct_change')
+        data=data[data['VISIT']!='SCREENING 1']
+        filtered_data=data[(data['PARAMCD']==param)]
+        filtered_data=filtered_data.rename(columns={'TRTA':'Treatment','VISIT':'Visit','PCTVAL':'Mean','PCTSTD':'Standard Deviation'})
+        fig=px.line(filtered_data,x='Visit',y='Mean',color='Treatment',hover_data={'Treatment':True,'Visit':True,'Mean':':.3g','Standard Deviation':':.3g'})
+        fig.update_layout(title=f'Percentage Change for {par}',xaxis_title='Visit',yaxis_title='Percent Change')
+        return fig
+
+## To create Bar graph to view the counts of the dataset per treatment per parameter and classify them according to their Lab Indicator variables
+def faceted_trend(lab,param,group):
+    par=param_label(param)
+    data=lab.view(param,'lab_indicator')
+    data=data[(data['AVISIT']=='Baseline') | (data['AVISIT']=='End of Treatment')]
+    data=data[~data['PARAMCD'].str.contains('_W*')]
+    column_mapping={'LBNRIND':'Lab Indicator','AVISIT':'Analysis Visit',
+                    'TRTA':'Treatment','PARAMCD':'Parameter','USUBJID':'Count'}
+    data=data.rename(columns=column_mapping)
+    filtered_data=data[(data['Treatment']==group) & (data['Parameter']==param)]
+    fig=px.bar(filtered_data,x='Analysis Visit',y='Count',color='Lab Indicator',barmode='group',category_orders={'Lab Indicator':['NORMAL','HIGH','LOW']},text='Count',title=f'Pre-Post Lab Indicators for Parameter {par}')
+    fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
+    fig.update_traces(textposition='inside',textfont=dict(size=14),insidetextanchor='middle')
+    return fig
+
+def line_with_sd(lab,param,abs,group):
+    par=param_label(param)
+    if abs==2:
+        data=lab.view(param,'abs_change_post')
+        data=data[data['VISIT']!='SCREENING 1']
+        data=data.assign(UPPER=data['ABSVAL']+data['ABSSTD'],LOWER=data['ABSVAL']-data['ABSSTD'])
+
+        filtered_data=data[(data['TRTA']==group) & (data['PARAMCD']==param)]
+        fig=go.Figure([go.Scatter(name='Mean Absolute Change',x=filtered_data['VISIT'],y=filtered_data['ABSVAL'],mode='lines',line=dict(color='rgb(31, 119, 180)'),showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Absolute Change:</b> %{y:.3g}<br>' +'<b>Standard Deviation:</b> %{customdata[0]:.3g}<br>'),customdata=filtered_data[['ABSSTD']]),
+                    go.Scatter(name='Upper limit',x=filtered_data['VISIT'],y=filtered_data['UPPER'],mode='lines',marker=dict(color="#444"),line=dict(width=0),fillcolor='rgba(68, 68, 68, 0.3)',fill='tonexty',showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Upper Limit:</b> %{y:.3g}<br>')),
+        go.Scatter(name='Lower limit',x=filtered_data['VISIT'],y=filtered_data['LOWER'],mode='lines',marker=dict(color="#444"),line=dict(width=0),fillcolor='rgba(68, 68, 68, 0.3)',fill='tonexty',showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Lower Limit:</b> %{y:.3g}<br>'))])
+        fig.update_layout(title=f'Absolute Change for {par} for Treatment Group {group}',xaxis_title='VISIT',yaxis_title='Absolute Change')
+        return fig
+    elif abs==3:
+        data=lab.view(param,'pct_change_post')
+        data=data[data['VISIT']!='SCREENING 1']
+        data=data.assign(UPPER=data['PCTVAL']+data['PCTSTD'],LOWER=data['PCTVAL']-data['PCTSTD'])
+
+        filtered_data=data[(data['TRTA']==group) & (data['PARAMCD']==param)]
+        fig=go.Figure([go.Scatter(name='Mean Percent Change',x=filtered_data['VISIT'],y=filtered_data['PCTVAL'],mode='lines',line=dict(color='rgb(31, 119, 180)'),showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Absolute Change:</b> %{y:.3g}<br>' +'<b>Standard Deviation:</b> %{customdata[0]:.3g}<br>'),customdata=filtered_data[['PCTSTD']]),
+                    go.Scatter(name='Upper limit',x=filtered_data['VISIT'],y=filtered_data['UPPER'],mode='lines',marker=dict(color="#444"),line=dict(width=0),fillcolor='rgba(68, 68, 68, 0.3)',fill='tonexty',showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Upper Limit:</b> %{y:.3g}<br>')),
+        go.Scatter(name='Lower limit',x=filtered_data['VISIT'],y=filtered_data['LOWER'],mode='lines',marker=dict(color="#444"),line=dict(width=0),fillcolor='rgba(68, 68, 68, 0.3)',fill='tonexty',showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Lower Limit:</b> %{y:.3g}<br>'))])
+        fig.update_layout(title=f'Percentage Change for {par} for Treatment Group {group}',xaxis_title='VISIT',yaxis_title='Percent Change')
+        return fig
+
+
+## Adverse Events, the `ae` argument is an ae_summary.AESummary, `group` is the selected treatment
+## or None for the all-treatments view and `basis` counts either AE records ('events') or unique subjects ('subjects')
+
+AEOUT_ORDER=['NOT RECOVERED/NOT RESOLVED','RECOVERED/RESOLVED','FATAL']
+AEREL_ORDER=['NONE','REMOTE','PROBABLE','POSSIBLE']
+
+def ae_mean_duration(ae,group=None):
+    df1 = ae.table('duration',group)
+    if group is None:
+        fig1 = px.scatter(df1, x='ADURN', y='AEBODSYS', color='TRTA',
+                              labels={'ADURN':'Mean Duration','AEBODSYS':'Body System','TRTA':'Treatment'},
+                              height=600, width=1500)
+        fig1.update_layout(margin=dict(l=0, r=0, b=0, t=40), font=dict(size=12))
+    else:
+        fig1 = px.scatter(df1, x='ADURN', y='AEBODSYS', color='TRTA',
+                              labels={'ADURN': 'Duration', 'AEBODSYS': 'Body System', 'TRTA': 'Treatment'},
+                              height=600, width=1500)
+        fig1.update_layout(margin=dict(l=200, r=0, b=0, t=40), font=dict(size=12))
+    fig1.update_layout(yaxis={'categoryorder':'total ascending'})
+    return fig1
+
+def ae_occurrences(ae,group=None,basis='events'):
+    df2 = ae.table('occurrences',group,basis)
+    fig2 = px.scatter(df2, x='Occurrences', y='AEBODSYS', color='TRTA',
+                          labels={'Occurrences': 'Occurrences' if basis=='events' else 'Subjects', 'AEBODSYS': 'Body System', 'TRTA': 'Treatment'},
+                          height=600, width=1500)
+    fig2.update_layout(margin=dict(l=0, r=0, b=0, t=40), font=dict(size=12))
+    fig2.update_layout(yaxis={'categoryorder':'total ascending'})
+    return fig2
+
+def ae_outcome(ae,group=None,basis='events'):
+    df5 = ae.table('outcome_all',basis=basis) if group is None else ae.table('outcome',group,basis)
+    fig5 = px.scatter(
+            df5,
+            x='USUBJID',
+            y='AEBODSYS',
+            color='AEOUT',
+            labels={'AEBODSYS': 'Body System', 'Count': 'Number of Cases','USUBJID':'Subject Count','AEOUT':'Outcome'},category_orders={'AEOUT':AEOUT_ORDER},
+            height=600,
+            width=1500)
+    if group is None:
+        fig5.update_layout(margin=dict(l=0, r=0, b=0, t=40),font=dict(size=12))
+    fig5.update_layout(yaxis={'categoryorder':'total ascending'})
+    return fig5
+
+## Always compares all treatments, also in the single treatment view
+def ae_hospitalisation(ae,basis='events'):
+    df3 = ae.table('hospitalisation',basis=basis)
+    fig3 = px.pie(df3, names='TRTA', values='Subject Count', hole=0.45,
+                  labels={'TRTA': 'Treatment', 'Subject Count': 'Count'},height=500,width=700)
+    return fig3
+
+def ae_severity(ae,group=None,basis='events'):
+    df4 = ae.table('severity',group,basis)
+    if group is None:
+        fig4 = px.sunburst(
+            df4.astype({'TRTA':str,'AESEV':str}),  # sunburst cannot build its hierarchy from categorical columns
+            path=['TRTA', 'AESEV'],  # Define hierarchy: Treatment -> Severity
+            values='USUBJID',
+            labels={'TRTA': 'Treatment', 'AESEV': 'Severity', 'USUBJID': 'Count'},
+            color='TRTA',height=500,width=700)
+    else:
+        fig4 = px.pie(df4, names='AESEV', values='USUBJID', hole=0.45,
+                      labels={'AESEV': 'Severity', 'USUBJID': 'Count'},height=500,width=700)
+    return fig4
+
+def ae_causality(ae,group=None,basis='events'):
+    df6 = ae.table('causality',group,basis)
+    if group is None:
+        fig6 = px.bar(df6, x='AEREL', y='USUBJID', color='TRTA',
+                      labels={'AEREL': 'Causality', 'USUBJID': 'Subject Count', 'TRTA': 'Treatment'},category_orders={'AEREL':AEREL_ORDER},
+                      height=400, width=900,barmode='group')
+    else:
+        fig6 = px.bar(df6, y='USUBJID', x='AEREL', color='TRTA',category_orders={'AEREL':AEREL_ORDER},
+                      labels={'AEREL': 'Causality', 'USUBJID': 'Subject Count', 'TRTA': 'Treatments'},
+                      height=400, width=800,barmode='group')
+    fig6.update_layout(margin=dict(l=0, r=0, b=0, t=40), font=dict(size=12))
+    return fig6
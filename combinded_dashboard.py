@@ -1,423 +1,219 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objs as go
+import ae_summary
+import charts
+import data_loader
+import lab_summary
+import metrics
+import warmup
+from figure_cache import cache
+from charts import param_dict
 st.set_page_config(layout='wide')
 
-df_adlb=pd.read_parquet('adlb_final.parquet')
-df_adsl=pd.read_parquet('adsl_final.parquet')
-df_adae=pd.read_parquet('adae_final.parquet')
+## st.plotly_chart encodes the figure for the browser, timed as the 'render' stage of `chart`, apart from the
+## 'serialize' stage of the figure cache
+def show(fig,chart):
+    with metrics.timed('render',chart):
+        st.plotly_chart(fig,use_container_width=True)
 
-tab1,tab2,tab3=st.tabs(['Subject Level','Laboratory','Adverse Events'])
+
+## No-op when the server was started through warmup.py or another session already started it
+warmup.start()
+
+## Widgets of hidden tabs are not rendered and streamlit would drop their state, re-assigning it keeps each tab's selection
+for key in ('adsl_demographic','adsl_distribution','lab_parameter','lab_plot_type','lab_box_mode','ae_count_basis'):
+    if key in st.session_state:
+        st.session_state[key]=st.session_state[key]
+
+## Only the open tab runs its body
+tab1,tab2,tab3=st.tabs(['Subject Level','Laboratory','Adverse Events'],key='section',on_change='rerun')
+metrics.begin(st.session_state.get('section'))
 
 st.sidebar.header('Dashboard Controls')
+if not warmup.is_ready():
+    st.sidebar.caption('Preparing data and charts, the first views may take a moment.')
+## Several studies can only be served from the partitioned datasets written by ingest.py
+selected_study=st.sidebar.selectbox('Select Study',data_loader.studies()) if data_loader.partitioned('adsl') else None
 selected_treatment=st.sidebar.selectbox('Select Treatment',('Placebo', 'Xanomeline High Dose', 'Xanomeline Low Dose'))
 
 adae_toggle=st.sidebar.checkbox('All',value=True)
 ## ADSL Dashboard
 with tab1:
-    age_group=['<65','65-80','>80']
-    df_adsl['AGEGR1']=pd.Categorical(df_adsl['AGEGR1'],categories=age_group,ordered=True)
-    def create_disposition_donut_plots(data,variable):
-        figs = {}
-        for group in data['ARM'].unique():
-            filtered_data = data[data['ARM'] == group]
-            fig = px.pie(filtered_data, names=variable, hole=0.5, 
-                        title=f'Summary in {group} Group') 
-            fig.update_traces( hovertemplate=
-    '<b>%{label}:</b><br>' +
-    'Count: %{value:.3g}<br>' +  
-    'Percentage: %{percent:.2%}') 
-            figs[group] = fig
-        return figs
-
-    def create_distribution_plots(data, parameter):
-        figs = {}
-        par_dict={'BMIBL':'Body Mass Index','WEIGHTBL':'Weight','HEIGHTBL':'Height'}
-        for group in data['ARM'].unique():
-            filtered_data = data[data['ARM'] == group]
-            fig = px.box(filtered_data, x='SEX', y=parameter, 
-                        title=f'{par_dict[parameter]} Distribution by Gender in {group} Group',category_orders={'SEX':['M','F']})
-            fig.update_layout(yaxis_title=par_dict[parameter])
-            figs[group] = fig
-        return figs
-
-    def create_subject_count_bar_plot(data):
-        figs = {}
-        for group in data['ARM'].unique():
-            filtered_data = data[data['ARM'] == group]
-            subject_count = filtered_data.groupby(by=['AGEGR1','SEX'])['SUBJID'].nunique().reset_index()  
-            fig = px.bar(subject_count, x='AGEGR1', y='SUBJID', color='SEX',barmode='group',title=f'Number of Subjects by AGE Group in {group} Group')
-            fig.update_layout(xaxis_title='Age Group', yaxis_title='Number of Subjects')
-            fig.update_traces(hovertemplate=
-    '<b>Age Group:</b> %{x}<br>' +
-    '<b>Subject Count:</b> %{y:.3g}<br>')
-            figs[group] = fig
-        return figs
-
-    st.title("Subject Level Analysis")
-
-    col1, col2 = st.columns(2)
-
-    with col1:
-        demographic_option=st.selectbox('Select a Variable to view Demographics',('Race','Ethinicity','Disposition'))
-        if demographic_option=='Disposition':
-            selected_variable='DCDECOD'
-        elif demographic_option=='Ethinicity':
-            selected_variable='ETHNIC'
-        elif demographic_option=='Race':
-            selected_variable='RACE'
-
-
-    with col2:
-        distribution_option=st.selectbox('Select type of Distribution',('BMI','Weight','Height'))
-        if distribution_option=='BMI':
-            selected_characteristic='BMIBL'
-        elif distribution_option=='Weight':
-            selected_characteristic='WEIGHTBL'
-        elif distribution_option=='Height':
-            selected_characteristic='HEIGHTBL'
-
-
-    disposition_plots = create_disposition_donut_plots(df_adsl,selected_variable)
-
-    col1,col2=st.columns(2)
-    with col1:
-        st.plotly_chart(disposition_plots[selected_treatment], use_container_width=True)
-
-    distribution_plots = create_distribution_plots(df_adsl, selected_characteristic)
-
-    with col2:
-        st.plotly_chart(distribution_plots[selected_treatment], use_container_width=True)
-
-    subject_count_plots = create_subject_count_bar_plot(df_adsl)
-
-    with col1:
-        st.plotly_chart(subject_count_plots[selected_treatment], use_container_width=True)
+    if tab1.open:
+        st.title("Subject Level Analysis")
+        df_adsl,adsl_version=data_loader.select('adsl',study=selected_study)
 
-with tab2:
-    st.title('Laboratory')
-
-    param_dict={'Hemoglobin (mmol/L)':'HGB', 'Hematocrit':'HCT',
-       'Ery. Mean Corpuscular Volume (fL)':'MCV',
-       'Ery. Mean Corpuscular Hemoglobin (fmol(Fe))':'MCH',
-       'Ery. Mean Corpuscular HGB Concentration (mmol/L)':'MCHC',
-       'Leukocytes (GI/L)':'WBC', 'Lymphocytes (GI/L)':'LYM', 'Monocytes (GI/L)':'MONO',
-       'Eosinophils (GI/L)':'EOS', 'Basophils (GI/L)':'BASO', 'Platelet (GI/L)':'PLAT',
-       'Erythrocytes (TI/L)':'RBC'}
-    
-    ##Function to create a bar group to compare means of Parameters pre-Post treatment
-    def pre_post(data,param):
-        par=list(param_dict.keys())[list(param_dict.values()).index(param)]
-        data=data.groupby(by=['TRTA','AVISIT','PARAMCD'])['AVAL'].mean().reset_index()
-        filtered_data=data.rename(columns={'TRTA':'Treatment','AVISIT':'Analysis Visit','AVAL':'Mean'})
-        fig=px.bar(filtered_data[((filtered_data['Analysis Visit']=='Baseline') | (filtered_data['Analysis Visit']=='End of Treatment')) & (filtered_data['PARAMCD']==param)],
-                    x='Treatment',y='Mean',color='Analysis Visit',barmode='group',
-                    title=f'Pre-Post Treatment per Treatment Group for Parameter {par}',
-                    hover_data={'Treatment':True,'Analysis Visit':True,'Mean':':.3g'})
-        fig.update_layout(yaxis_title=f'{par}',xaxis_title='Treatment')
-        return fig
-
-
-    ##Function to create a line chart and compare treatments with their means per parameter
-    def param_trend(data,param):
-        par=list(param_dict.keys())[list(param_dict.values()).index(param)]
-        data=data.groupby(by=['TRTA','VISIT','PARAMCD'])['AVAL'].agg([('AVAL','mean'),('ASTD','std')]).reset_index()
-        filtered_data=data
-        filtered_data = filtered_data.rename(columns={'VISIT': 'Visit','AVAL': 'Mean','TRTA': 'Treatment','ASTD': 'Standard Deviation'})
-        fig=px.line(filtered_data[filtered_data['PARAMCD']==param],
-                x='Visit',y='Mean',color='Treatment',title=f'Mean {par} Value across VISITS',hover_data={'Visit':True,'Mean':':.3g','Treatment':True,'Standard Deviation':':.3g'})
-        fig.update_layout(yaxis_title=f'{par}')
-        return fig
-
-        
-    ##To create a Box plot to understand the distribution of parameters value per treatment across weeks
-    def box_treatment(data,param):
-        figs={}
-        par=list(param_dict.keys())[list(param_dict.values()).index(param)]
-        data=data.rename(columns={'VISIT':'Visit','AVAL':'Value','LBNRIND':'Lab Indicator','USUBJID':'Subject ID'})
-        for group in data['TRTA'].unique():
-            filtered_data=data[data['TRTA']==group]
-            fig=px.box(filtered_data[ (filtered_data['PARAMCD']==param)],
-                    x='Visit',y='Value',
-                    title=f'Distribution of Paramter {par} for Treatment Group {group}',
-                    hover_data={'Visit':True,'Value':':.3g','Lab Indicator':True,'Subject ID':True})
-            fig.update_layout(xaxis_title='VISIT',yaxis_title=f'{par}')
-            figs[group]=fig
-        return figs
-
-    ## To create a line chart with SD for the values of Absolute Change and Percentage Change
-    def line_with_range(data,param,abs):
-        par=list(param_dict.keys())[list(param_dict.values()).index(param)]
-        if abs==2:
-            data=data.groupby(by=['TRTA','VISIT','PARAMCD'])['ABSVAL'].agg([('ABSVAL','mean'),('ABSSTD','std')]).reset_index()
-            data=data[data['VISIT']!='SCREENING 1']
-            filtered_data=data[(data['PARAMCD']==param)]
-            filtered_data=filtered_data.rename(columns={'TRTA':'Treatment','VISIT':'Visit','ABSVAL':'Mean','ABSSTD':'Standard Deviation'})
-            fig=px.line(filtered_data,x='Visit',y='Mean',color='Treatment',hover_data={'Treatment':True,'Visit':True,'Mean':':.3g','Standard Deviation':':.3g'})
-            fig.update_layout(title=f'Absolute Change for {par}',xaxis_title='Visit',yaxis_title='Absolute Change')
-            return fig
-        elif abs==3: 
-            data=data.groupby(by=['TRTA','VISIT','PARAMCD'])['PCTVAL'].agg([('PCTVAL','mean'),('PCTSTD','std')]).reset_index()
-            data=data[data['VISIT']!='SCREENING 1']
-            filtered_data=data[(data['PARAMCD']==param)]
-            filtered_data=filtered_data.rename(columns={'TRTA':'Treatment','VISIT':'Visit','PCTVAL':'Mean','PCTSTD':'Standard Deviation'})
-            fig=px.line(filtered_data,x='Visit',y='Mean',color='Treatment',hover_data={'Treatment':True,'Visit':True,'Mean':':.3g','Standard Deviation':':.3g'})
-            fig.update_layout(title=f'Percentage Change for {par}',xaxis_title='Visit',yaxis_title='Percent Change')  
-            return fig
-
-    ## To create Bar graph to view the counts of the dataset per treatment per parameter and classify them according to their Lab Indicator variables
-    def faceted_trend(data,param):
-        par=list(param_dict.keys())[list(param_dict.values()).index(param)]
-        data=data.groupby(by=['TRTA','AVISIT','PARAMCD','LBNRIND'])['USUBJID'].nunique().reset_index()
-        data=data[(data['AVISIT']=='Baseline') | (data['AVISIT']=='End of Treatment')]
-        data=data[~data['PARAMCD'].str.contains('_W*')]
-        column_mapping={'LBNRIND':'Lab Indicator','AVISIT':'Analysis Visit',
-                        'TRTA':'Treatment','PARAMCD':'Parameter','USUBJID':'Count'}
-        data=data.rename(columns=column_mapping)
-        figs={}
-        for group in data['Treatment'].unique():
-            filtered_data=data[(data['Treatment']==group) & (data['Parameter']==param)]   
-            fig=px.bar(filtered_data,x='Analysis Visit',y='Count',color='Lab Indicator',barmode='group',category_orders={'Lab Indicator':['NORMAL','HIGH','LOW']},text='Count',title=f'Pre-Post Lab Indicators for Parameter {par}')
-            fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
-            fig.update_traces(textposition='inside',textfont=dict(size=14),insidetextanchor='middle')
-            figs[group]=fig
-        return figs
-
-    def line_with_sd(data,param,abs):
-        data['ABLFL']=data['ABLFL'].fillna('N')
-        data=data[data['ABLFL']=='N']
-        figs={}
-        par=list(param_dict.keys())[list(param_dict.values()).index(param)]
-        if abs==2:
-            data=data.groupby(by=['TRTA','VISIT','PARAMCD'])['ABSVAL'].agg([('ABSVAL','mean'),('ABSSTD','std')]).reset_index()
-            data=data[data['VISIT']!='SCREENING 1']
-            data['UPPER']=data['ABSVAL']+data['ABSSTD']
-            data['LOWER']=data['ABSVAL']-data['ABSSTD']
-
-            for group in data['TRTA'].unique():
-                filtered_data=data[(data['TRTA']==group) & (data['PARAMCD']==param)]
-                fig=go.Figure([go.Scatter(name='Mean Absolute Change',x=filtered_data['VISIT'],y=filtered_data['ABSVAL'],mode='lines',line=dict(color='rgb(31, 119, 180)'),showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Absolute Change:</b> %{y:.3g}<br>' +'<b>Standard Deviation:</b> %{customdata[0]:.3g}<br>'),customdata=filtered_data[['ABSSTD']]),
-                            go.Scatter(name='Upper limit',x=filtered_data['VISIT'],y=filtered_data['UPPER'],mode='lines',marker=dict(color="#444"),line=dict(width=0),fillcolor='rgba(68, 68, 68, 0.3)',fill='tonexty',showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Upper Limit:</b> %{y:.3g}<br>')),
-                go.Scatter(name='Lower limit',x=filtered_data['VISIT'],y=filtered_data['LOWER'],mode='lines',marker=dict(color="#444"),line=dict(width=0),fillcolor='rgba(68, 68, 68, 0.3)',fill='tonexty',showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Lower Limit:</b> %{y:.3g}<br>'))])
-                fig.update_layout(title=f'Absolute Change for {par} for Treatment Group {group}',xaxis_title='VISIT',yaxis_title='Absolute Change')
-                figs[group]=fig
-            return figs
-        elif abs==3: 
-            data=data.groupby(by=['TRTA','VISIT','PARAMCD'])['PCTVAL'].agg([('PCTVAL','mean'),('PCTSTD','std')]).reset_index()
-            data=data[data['VISIT']!='SCREENING 1']
-            data['UPPER']=data['PCTVAL']+data['PCTSTD']
-            data['LOWER']=data['PCTVAL']-data['PCTSTD']
-
-            for group in data['TRTA'].unique():
-                filtered_data=data[(data['TRTA']==group) & (data['PARAMCD']==param)]
-                fig=go.Figure([go.Scatter(name='Mean Percent Change',x=filtered_data['VISIT'],y=filtered_data['PCTVAL'],mode='lines',line=dict(color='rgb(31, 119, 180)'),showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Absolute Change:</b> %{y:.3g}<br>' +'<b>Standard Deviation:</b> %{customdata[0]:.3g}<br>'),customdata=filtered_data[['PCTSTD']]),
-                            go.Scatter(name='Upper limit',x=filtered_data['VISIT'],y=filtered_data['UPPER'],mode='lines',marker=dict(color="#444"),line=dict(width=0),fillcolor='rgba(68, 68, 68, 0.3)',fill='tonexty',showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Upper Limit:</b> %{y:.3g}<br>')),
-                go.Scatter(name='Lower limit',x=filtered_data['VISIT'],y=filtered_data['LOWER'],mode='lines',marker=dict(color="#444"),line=dict(width=0),fillcolor='rgba(68, 68, 68, 0.3)',fill='tonexty',showlegend=False,hovertemplate=('<b>Visit:</b> %{x}<br>' +'<b>Lower Limit:</b> %{y:.3g}<br>'))])
-                fig.update_layout(title=f'Percentage Change for {par} for Treatment Group {group}',xaxis_title='VISIT',yaxis_title='Percent Change')
-                figs[group]=fig
-            return figs
-        
-    col1,col2=st.columns(2)
-
-    with col2:
-        parameter_option=st.selectbox('Select a Parameter to View',('Hemoglobin (mmol/L)', 'Hematocrit',
-        'Ery. Mean Corpuscular Volume (fL)',
-        'Ery. Mean Corpuscular Hemoglobin (fmol(Fe))',
-        'Ery. Mean Corpuscular HGB Concentration (mmol/L)',
-        'Leukocytes (GI/L)', 'Lymphocytes (GI/L)', 'Monocytes (GI/L)',
-        'Eosinophils (GI/L)', 'Basophils (GI/L)', 'Platelet (GI/L)',
-        'Erythrocytes (TI/L)'))
-
-
-    # with col1:
-    #     visit_options=st.toggle('View At End Of Treatment')
-    #     if visit_options:
-    #         donut_plots=create_baseline_end(df,'End of Treatment',param[parameter_option])
-    #     else:
-    #         donut_plots=create_baseline_end(df,'Baseline',param[parameter_option])
-    #     st.plotly_chart(donut_plots[selected_treatment],use_container_width=True)
-
-    pre_post_plot=pre_post(df_adlb,param_dict[parameter_option])
-
-    
-    with col1:
-
-        abs_or_pct=st.selectbox('Select Plot Type:',('Mean Change','Mean Absolute Change','Mean Percent Change'))
-        if abs_or_pct=='Mean Change':
-            abs=1
-        elif abs_or_pct=='Mean Absolute Change':
-            abs=2
-        else:
-            abs=3
+        col1, col2 = st.columns(2)
 
+        with col1:
+            demographic_option=st.selectbox('Select a Variable to view Demographics',('Race','Ethinicity','Disposition'),key='adsl_demographic')
+            if demographic_option=='Disposition':
+                selected_variable='DCDECOD'
+            elif demographic_option=='Ethinicity':
+                selected_variable='ETHNIC'
+            elif demographic_option=='Race':
+                selected_variable='RACE'
 
-    abs_plot=line_with_range(df_adlb,param_dict[parameter_option],abs)
 
-    act_trend=param_trend(df_adlb,param_dict[parameter_option])
-  
+        with col2:
+            distribution_option=st.selectbox('Select type of Distribution',('BMI','Weight','Height'),key='adsl_distribution')
+            if distribution_option=='BMI':
+                selected_characteristic='BMIBL'
+            elif distribution_option=='Weight':
+                selected_characteristic='WEIGHTBL'
+            elif distribution_option=='Height':
+                selected_characteristic='HEIGHTBL'
 
-    col1,col2=st.columns(2)
 
-    with col1:  
-        if abs==1:
-            st.plotly_chart(act_trend,use_container_width=True)
-        elif abs==2:
-            st.plotly_chart(abs_plot,use_container_width=True)
-        else:
-            st.plotly_chart(abs_plot,use_container_width=True)
+        disposition_plot = charts.cached_figure(charts.create_disposition_donut_plot,adsl_version,df_adsl,selected_variable,selected_treatment)
 
-    with col2:
-        if abs==1:
-            box_plot=box_treatment(df_adlb,param_dict[parameter_option])
-            st.plotly_chart(box_plot[selected_treatment],use_container_width=True)
-        elif abs==2:
-            plot_with_sd=line_with_sd(df_adlb,param_dict[parameter_option],abs)
-            st.plotly_chart(plot_with_sd[selected_treatment],use_container_width=True)
-        elif abs==3:
-            plot_with_sd=line_with_sd(df_adlb,param_dict[parameter_option],abs)
-            st.plotly_chart(plot_with_sd[selected_treatment],use_container_width=True)
+        col1,col2=st.columns(2)
+        with col1:
+            show(disposition_plot,'create_disposition_donut_plot')
 
+        distribution_plot = charts.cached_figure(charts.create_distribution_plot,adsl_version,df_adsl,selected_characteristic,selected_treatment)
 
-    col3,col4=st.columns(2)
-    with col3:
-        st.plotly_chart(pre_post_plot,use_container_width=True)
+        with col2:
+            show(distribution_plot,'create_distribution_plot')
 
-    with col4:
-        facet_plot=faceted_trend(df_adlb,param_dict[parameter_option])
-        st.plotly_chart(facet_plot[selected_treatment],use_container_width=True)
+        subject_count_plot = charts.cached_figure(charts.create_subject_count_bar_plot,adsl_version,df_adsl,selected_treatment)
 
-with tab3:
-    st.title('Adverse Events')
-    # Grouping data as per requirements
-    df1 = df_adae.groupby(by=['TRTA', 'AEBODSYS'])['ADURN'].mean().reset_index()
-    df2 = df_adae.groupby(by=['TRTA', 'AEBODSYS'])['USUBJID'].count().reset_index()
-    df2.rename(columns={'USUBJID': 'Occurrences'}, inplace=True)
-    df3 = df_adae.groupby(by=['TRTA','AESHOSP'])['USUBJID'].count().reset_index()
-    df3=df3[df3['AESHOSP']=='Y']
-    df3.rename(columns={'USUBJID': 'Subject Count'}, inplace=True)
-    df4 = df_adae.groupby(by=['TRTA', 'AESEV'])['USUBJID'].count().reset_index()
-    df5 = df_adae.groupby(by=['AEBODSYS', 'AEOUT'])['USUBJID'].count().reset_index()
-    df5_1=df_adae.groupby(by=['TRTA','AEBODSYS','AEOUT'])['USUBJID'].count().reset_index()
-    df6 = df_adae.groupby(by=['TRTA', 'AEREL'])['USUBJID'].count().reset_index()
-
-    if adae_toggle:
-        st.header("Adverse Events Overview for All Treatments")
+        with col1:
+            show(subject_count_plot,'create_subject_count_bar_plot')
 
+with tab2:
+    if tab2.open:
+        st.title('Laboratory')
+
+        col1,col2=st.columns(2)
+
+        with col2:
+            parameter_option=st.selectbox('Select a Parameter to View',('Hemoglobin (mmol/L)', 'Hematocrit',
+            'Ery. Mean Corpuscular Volume (fL)',
+            'Ery. Mean Corpuscular Hemoglobin (fmol(Fe))',
+            'Ery. Mean Corpuscular HGB Concentration (mmol/L)',
+            'Leukocytes (GI/L)', 'Lymphocytes (GI/L)', 'Monocytes (GI/L)',
+            'Eosinophils (GI/L)', 'Basophils (GI/L)', 'Platelet (GI/L)',
+            'Erythrocytes (TI/L)'),key='lab_parameter')
+
+
+        # with col1:
+        #     visit_options=st.toggle('View At End Of Treatment')
+        #     if visit_options:
+        #         donut_plots=create_baseline_end(df,'End of Treatment',param[parameter_option])
+        #     else:
+        #         donut_plots=create_baseline_end(df,'Baseline',param[parameter_option])
+        #     st.plotly_chart(donut_plots[selected_treatment],use_container_width=True)
+
+        param=param_dict[parameter_option]
+        ## The summaries compare treatments, the box plot only needs the selected arm
+        df_adlb,adlb_version=data_loader.select('adlb',study=selected_study,PARAMCD=param)
+        lab=lab_summary.get(df_adlb,adlb_version)
+        ## Figures of a parameter stay cached while appended records only touch other parameters
+        lab_version=lab.param_version(param)
+
+        with col1:
+
+            abs_or_pct=st.selectbox('Select Plot Type:',('Mean Change','Mean Absolute Change','Mean Percent Change'),key='lab_plot_type')
+            if abs_or_pct=='Mean Change':
+                abs=1
+            elif abs_or_pct=='Mean Absolute Change':
+                abs=2
+            else:
+                abs=3
+
+
+        col1,col2=st.columns(2)
+
+        with col2:
+            if abs==1:
+                ## Summary sends precomputed quartiles and a capped set of outliers instead of every AVAL row
+                box_mode=st.radio('Box Plot Points',('Summary','All Points'),horizontal=True,key='lab_box_mode')
+                box_builder=charts.box_treatment_summary if box_mode=='Summary' else charts.box_treatment
+                if data_loader.partitioned('adlb'):
+                    df_box,box_version=data_loader.select('adlb',study=selected_study,TRTA=selected_treatment,PARAMCD=param)
+                else:
+                    ## The flat file is the frame the summary was built from, its box plots change only with the parameter's rows
+                    df_box,box_version=df_adlb,lab_version
+
+        ## The four charts are independent, with DASHBOARD_WORKERS set they are built in parallel
+        if abs==1:
+            jobs=[(charts.param_trend,lab_version,lab,param),
+                  (box_builder,box_version,df_box,param,selected_treatment)]
+        else:
+            jobs=[(charts.line_with_range,lab_version,lab,param,abs),
+                  (charts.line_with_sd,lab_version,lab,param,abs,selected_treatment)]
+        jobs+=[(charts.pre_post,lab_version,lab,param),
+               (charts.faceted_trend,lab_version,lab,param,selected_treatment)]
+        trend_plot,side_plot,pre_post_plot,facet_plot=charts.cached_figures(*jobs)
 
-        st.subheader('Mean Duration of Adverse Event')
-        fig1 = px.scatter(df1, x='ADURN', y='AEBODSYS', color='TRTA',
-                              labels={'ADURN':'Mean Duration','AEBODSYS':'Body System','TRTA':'Treatment'},
-                              height=600, width=1500)
-        fig1.update_layout(margin=dict(l=0, r=0, b=0, t=40), font=dict(size=12))
-        fig1.update_layout(yaxis={'categoryorder':'total ascending'})  # Adjusted layout
-        st.plotly_chart(fig1, use_container_width=True)
-
-        st.subheader('Occurrences in Treatment')
-        fig2 = px.scatter(df2, x='Occurrences', y='AEBODSYS', color='TRTA',
-                              labels={'Occurrences': 'Occurrences', 'AEBODSYS': 'Body System', 'TRTA': 'Treatment'},
-                              height=600, width=1500)
-        fig2.update_layout(margin=dict(l=0, r=0, b=0, t=40), font=dict(size=12))  
-        fig2.update_layout(yaxis={'categoryorder':'total ascending'})
-        st.plotly_chart(fig2, use_container_width=True)
-        
-        st.subheader('Distribution of Adverse Event by Outcome')
-        fig5 = px.scatter(
-                df5,
-                x='USUBJID',  
-                y='AEBODSYS',
-                color='AEOUT',  
-                labels={'AEBODSYS': 'Body System', 'Count': 'Number of Cases','USUBJID':'Subject Count','AEOUT':'Outcome'},category_orders={'AEOUT':['NOT RECOVERED/NOT RESOLVED','RECOVERED/RESOLVED','FATAL']},
-                height=600,
-                width=1500)
-        fig5.update_layout(margin=dict(l=0, r=0, b=0, t=40),font=dict(size=12))
-        fig5.update_layout(yaxis={'categoryorder':'total ascending'})
-        st.plotly_chart(fig5,use_container_width=True)
+        with col1:
+            show(trend_plot,jobs[0][0].__name__)
 
-        col3, col4 = st.columns(2)
+        with col2:
+            show(side_plot,jobs[1][0].__name__)
 
+
+        col3,col4=st.columns(2)
         with col3:
-            st.subheader('Hospitalisation Count')
-            fig3 = px.pie(df3, names='TRTA', values='Subject Count', hole=0.45,
-                          labels={'TRTA': 'Treatment', 'Subject Count': 'Count'},height=500,width=700)
-            st.plotly_chart(fig3, use_container_width=True)
+            show(pre_post_plot,'pre_post')
 
         with col4:
-            st.subheader('Subject Count by Severity of Adverse Event')
-            fig4 = px.sunburst(
-                df4,
-                path=['TRTA', 'AESEV'],  # Define hierarchy: Treatment -> Severity
-                values='USUBJID',  # Size of each slice represents duration
-                labels={'TRTA': 'Treatment', 'AESEV': 'Severity', 'USUBJID': 'Count'},
-                color='TRTA',height=500,width=700)
-            st.plotly_chart(fig4, use_container_width=True)
-        
-        col5,col6 = st.columns(2)
-        with col5:
-            st.subheader('Causality Count')
-            fig6 = px.bar(df6, x='AEREL', y='USUBJID', color='TRTA',
-                          labels={'AEREL': 'Causality', 'USUBJID': 'Subject Count', 'TRTA': 'Treatment'},category_orders={'AEREL':['NONE','REMOTE','PROBABLE','POSSIBLE']},
-                          height=400, width=900,barmode='group')
-            fig6.update_layout(margin=dict(l=0, r=0, b=0, t=40), font=dict(size=12))  
-            st.plotly_chart(fig6, use_container_width=True) 
-    else:
-        st.header(f"Adverse Events Overview for {selected_treatment}")
+            show(facet_plot,'faceted_trend')
+
+with tab3:
+    if tab3.open:
+        st.title('Adverse Events')
+        df_adae,adae_version=data_loader.select('adae',study=selected_study)
+        ae=ae_summary.get(df_adae,adae_version)
+        ae_group=None if adae_toggle else selected_treatment
+        ## Figures of a treatment stay cached while appended records only touch other treatments
+        group_version=ae.group_version(ae_group)
+        count_option=st.radio('Count',('Events','Subjects'),horizontal=True,key='ae_count_basis',
+                              help='Events counts every adverse event record, Subjects counts each subject once')
+        basis=count_option.lower()
+
+        if adae_toggle:
+            st.header("Adverse Events Overview for All Treatments")
+        else:
+            st.header(f"Adverse Events Overview for {selected_treatment}")
 
+        ## The six charts are independent, with DASHBOARD_WORKERS set they are built in parallel
+        fig1,fig2,fig5,fig3,fig4,fig6=charts.cached_figures((charts.ae_mean_duration,group_version,ae,ae_group),
+                                                            (charts.ae_occurrences,group_version,ae,ae_group,basis),
+                                                            (charts.ae_outcome,group_version,ae,ae_group,basis),
+                                                            (charts.ae_hospitalisation,ae.group_version(),ae,basis),
+                                                            (charts.ae_severity,group_version,ae,ae_group,basis),
+                                                            (charts.ae_causality,group_version,ae,ae_group,basis))
 
         st.subheader('Mean Duration of Adverse Event')
-        df1_filtered = df1[df1['TRTA'] == selected_treatment]
-        fig1 = px.scatter(df1_filtered, x='ADURN', y='AEBODSYS', color='TRTA',
-                              labels={'ADURN': 'Duration', 'AEBODSYS': 'Body System', 'TRTA': 'Treatment'},
-                              height=600, width=1500)
-        fig1.update_layout(margin=dict(l=200, r=0, b=0, t=40), font=dict(size=12))
-        fig1.update_layout(yaxis={'categoryorder':'total ascending'})
-        st.plotly_chart(fig1, use_container_width=True)
-
-        st.subheader(f'Occurrences in Treatment Group {selected_treatment}')
-        df2_filtered = df2[df2['TRTA'] == selected_treatment]
-        fig2 = px.scatter(df2_filtered, x='Occurrences', y='AEBODSYS', color='TRTA',
-                              labels={'Occurrences': 'Occurrences', 'AEBODSYS': 'Body System', 'TRTA': 'Treatment'},
-                              height=600, width=1500)
-        fig2.update_layout(margin=dict(l=0, r=0, b=0, t=40), font=dict(size=12)) 
-        fig2.update_layout(yaxis={'categoryorder':'total ascending'})
-        st.plotly_chart(fig2, use_container_width=True)
-        
-        st.subheader(f'Distribution of Adverse Event by Outcome in Treatment {selected_treatment}')
-        df5_filtered = df5_1[df5_1['TRTA'] == selected_treatment]
-        fig5 = px.scatter(
-                df5_filtered,
-                x='USUBJID',  # Use 'Count' for the x-axis
-                y='AEBODSYS',  # Use 'AEBODSYS' for the y-axis
-                color = 'AEOUT',# Different colors for different treatments
-                labels={'AEBODSYS': 'Body System', 'Count': 'Number of Cases','USUBJID':'Subject Count','AEOUT':'Outcome'},category_orders={'AEOUT':['NOT RECOVERED/NOT RESOLVED','RECOVERED/RESOLVED','FATAL']} , # Labels for axes and legend
-                height=600,
-                width=1500)
-        fig5.update_layout(yaxis={'categoryorder':'total ascending'})
-        st.plotly_chart(fig5,use_container_width=True)
+        show(fig1,'ae_mean_duration')
+
+        st.subheader('Occurrences in Treatment' if adae_toggle else f'Occurrences in Treatment Group {selected_treatment}')
+        show(fig2,'ae_occurrences')
+
+        st.subheader('Distribution of Adverse Event by Outcome' if adae_toggle else f'Distribution of Adverse Event by Outcome in Treatment {selected_treatment}')
+        show(fig5,'ae_outcome')
 
         col3, col4 = st.columns(2)
 
         with col3:
             st.subheader('Hospitalisation Count')
-            fig3 = px.pie(df3, names='TRTA', values='Subject Count', hole=0.45,
-                          labels={'TRTA': 'Treatment', 'Subject Count': 'Count'},height=500,width=700)
-            st.plotly_chart(fig3, use_container_width=True)
+            show(fig3,'ae_hospitalisation')
 
         with col4:
             st.subheader('Subject Count by Severity of Adverse Event')
-            df4_filtered = df4[df4['TRTA'] == selected_treatment]
-            fig4 = px.pie(df4_filtered, names='AESEV', values='USUBJID', hole=0.45,
-                          labels={'AESEV': 'Severity', 'USUBJID': 'Count'},height=500,width=700)  # Increased width
-            st.plotly_chart(fig4, use_container_width=True)
+            show(fig4,'ae_severity')
 
-
-        col5,col6 = st.columns(2)    
-        with col5:    
+        col5,col6 = st.columns(2)
+        with col5:
             st.subheader('Causality Count')
-            df6_filtered = df6[df6['TRTA'] == selected_treatment]
-            fig6 = px.bar(df6_filtered, y='USUBJID', x='AEREL', color='TRTA',category_orders={'AEREL':['NONE','REMOTE','PROBABLE','POSSIBLE']},
-                          labels={'AEREL': 'Causality', 'USUBJID': 'Subject Count', 'TRTA': 'Treatments'},
-                          height=400, width=800,barmode='group' # Increased size
-                          )
-            fig6.update_layout(margin=dict(l=0, r=0, b=0, t=40), font=dict(size=12))  # Adjusted layout
-            st.plotly_chart(fig6, use_container_width=True)
+            show(fig6,'ae_causality')
+
+rerun=metrics.end()
+## Stage timings of this rerun and the figure cache counters, shown when DASHBOARD_ADMIN=1
+if metrics.ADMIN:
+    with st.sidebar.expander('Performance'):
+        st.metric('Rerun',f"{rerun['seconds']*1000:.0f} ms")
+        st.dataframe([{'Stage':s['stage'],'Chart':s['chart'],'ms':round(s['seconds']*1000,1)} for s in rerun['stages']],
+                     hide_index=True,use_container_width=True)
+        st.json(cache.stats())
@@ -0,0 +1,291 @@
+import contextlib
+import glob
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import quote,unquote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+import metrics
+
+DATA_DIR=os.environ.get('DASHBOARD_DATA_DIR',os.path.dirname(os.path.abspath(__file__)))
+
+## Root of the partitioned datasets written by ingest.py, used instead of the flat files when present
+DATASET_DIR=os.environ.get('DASHBOARD_DATASET_DIR',os.path.join(DATA_DIR,'dataset'))
+
+FILES={'adsl':'adsl_final.parquet','adlb':'adlb_final.parquet','adae':'adae_final.parquet'}
+
+## Only the columns the tabs actually read are decoded from each file
+COLUMNS={'adsl':['ARM','SEX','AGEGR1','SUBJID','DCDECOD','ETHNIC','RACE','BMIBL','WEIGHTBL','HEIGHTBL'],
+         'adlb':['USUBJID','TRTA','VISIT','AVISIT','PARAMCD','AVAL','ABSVAL','PCTVAL','LBNRIND','ABLFL'],
+         'adae':['USUBJID','TRTA','AEBODSYS','ADURN','AESHOSP','AESEV','AEOUT','AEREL']}
+
+## Partition columns of each domain in the partitioned layout, in directory order
+PARTITIONS={'adsl':['STUDYID','ARM'],
+            'adlb':['STUDYID','TRTA','PARAMCD'],
+            'adae':['STUDYID','TRTA']}
+
+## Records added to a flat file after it was written, <APPEND_DIR>/<domain>/*.parquet applied in file name order.
+## New files are read on their own and appended to the loaded frame instead of decoding everything again.
+APPEND_DIR=os.environ.get('DASHBOARD_APPEND_DIR',os.path.join(DATA_DIR,'appends'))
+
+## Directory of uncompressed Arrow copies of the loaded frames. Every server process on the node memory-maps the same
+## copy, so the numeric columns live once in the page cache instead of once per process.
+SHARED_DIR=os.environ.get('DASHBOARD_SHARED_DIR')
+
+## Number of partition selections kept in memory
+MAX_PARTITIONS=int(os.environ.get('DASHBOARD_PARTITION_CACHE','32'))
+
+## Fixed category orders, everything else keeps the order found in the file
+CATEGORY_ORDERS={'AGEGR1':['<65','65-80','>80']}
+
+_cache={}
+_partitions=OrderedDict()
+_lock=threading.Lock()
+
+
+def _stat(path):
+    st=os.stat(path)
+    return (st.st_mtime_ns,st.st_size)
+
+
+def _file_hash(path):
+    digest=hashlib.sha256()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20),b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+## Converts the string columns to categoricals, so subject IDs and other labels are stored as small integer codes,
+## downcasts the numeric columns that fit a smaller type without losing a value and applies the clean-ups
+## the tabs used to do on every rerun
+def normalize(data):
+    data=data.copy()
+    if 'ABLFL' in data.columns:
+        data['ABLFL']=data['ABLFL'].fillna('N')
+    for col in data.columns:
+        if col in CATEGORY_ORDERS:
+            data[col]=pd.Categorical(data[col],categories=CATEGORY_ORDERS[col],ordered=True)
+        elif isinstance(data[col].dtype,pd.CategoricalDtype):
+            continue
+        elif pd.api.types.is_object_dtype(data[col]) or pd.api.types.is_string_dtype(data[col]):
+            data[col]=data[col].astype('category')
+        elif pd.api.types.is_integer_dtype(data[col]) and not pd.api.types.is_bool_dtype(data[col]):
+            data[col]=pd.to_numeric(data[col],downcast='integer')
+        elif pd.api.types.is_float_dtype(data[col]) and data[col].dtype.itemsize>4:
+            narrow=data[col].astype('float32')
+            if ((narrow.astype(data[col].dtype)==data[col])|data[col].isna()).all():
+                data[col]=narrow
+    return data
+
+
+def _read(domain,path):
+    return normalize(pd.read_parquet(path,columns=COLUMNS[domain]))
+
+
+def _append_files(domain):
+    return tuple((path,)+_stat(path) for path in sorted(glob.glob(os.path.join(APPEND_DIR,domain,'*.parquet'))))
+
+
+## Concatenates normalized frames, categoricals with different categories stay categoricals
+def concat(frames):
+    data=pd.concat(frames,ignore_index=True)
+    for col in frames[0].columns:
+        dtypes=[frame[col].dtype for frame in frames]
+        if all(isinstance(dtype,pd.CategoricalDtype) for dtype in dtypes) and not isinstance(data[col].dtype,pd.CategoricalDtype):
+            categories=pd.api.types.union_categoricals([frame[col] for frame in frames]).categories
+            data[col]=pd.Categorical(data[col],categories=categories)
+    return data
+
+
+def _shared_path(domain,version):
+    return os.path.join(SHARED_DIR,f'{domain}-{version}.arrow')
+
+
+## Memory-mapped frame of a domain version written by `_share`, None when there is no shared copy
+## or another process removed it meanwhile. Numeric columns without nulls point straight into the mapping,
+## only the category codes are copied.
+def _attach(domain,version):
+    if not SHARED_DIR:
+        return None
+    try:
+        with pa.memory_map(_shared_path(domain,version)) as source:
+            table=ipc.open_file(source).read_all()
+    except FileNotFoundError:
+        return None
+    return table.to_pandas(split_blocks=True)
+
+
+## Writes `data` as the shared copy of a domain version, unless another process already did, and returns the mapped frame.
+## Replicas starting together may all write the copy and clean up the same stale ones, `data` itself is returned
+## when the copy is gone again.
+def _share(domain,version,data):
+    if not SHARED_DIR:
+        return data
+    path=_shared_path(domain,version)
+    if not os.path.exists(path):
+        table=pa.Table.from_pandas(data)
+        ## NaN is kept as a float value instead of a null, columns with nulls could not be mapped without a copy
+        for i,col in enumerate(data.columns):
+            if pd.api.types.is_float_dtype(data[col]):
+                table=table.set_column(i,col,pa.array(data[col].to_numpy()))
+        os.makedirs(SHARED_DIR,exist_ok=True)
+        tmp=f'{path}.{os.getpid()}.tmp'
+        with ipc.new_file(tmp,table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp,path)
+        for old in glob.glob(_shared_path(domain,'*')):
+            if old!=path:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(old)
+    shared=_attach(domain,version)
+    return data if shared is None else shared
+
+
+## Advances a cache entry to the version that adds append file `path` with `rows` records,
+## `lineage` remembers where its rows start, so summaries can be updated with only those rows
+def _advance(entry,path,rows):
+    parent=entry['version']
+    entry['version']=hashlib.sha256((parent+_file_hash(path)).encode()).hexdigest()[:16]
+    entry['lineage'][entry['version']]=(parent,entry['rows'])
+    entry['rows']+=rows
+
+
+## Adds the append files of `stamps` to a cache entry, reading only those files
+def _apply(domain,entry,stamps):
+    frames=[entry['data']]
+    for stamp in stamps:
+        delta=_read(domain,stamp[0])
+        _advance(entry,stamp[0],len(delta))
+        frames.append(delta)
+    if len(frames)>1:
+        entry['data']=_share(domain,entry['version'],concat(frames))
+    entry['appends']+=stamps
+
+
+## Returns (frame, version) for a domain ('adsl', 'adlb' or 'adae'), the shared, normalized frame with its append files
+## and the content hash of the file and its append files, used to key anything derived from the data. Both come from
+## one look at the cache, so an append landing meanwhile never pairs a frame with another version.
+## The file is only decoded again when its mtime/size changes and its content hash differs, new append files
+## are read on their own. The returned frame is shared between sessions and must not be modified in place.
+def load(domain):
+    path=os.path.join(DATA_DIR,FILES[domain])
+    stat=_stat(path)
+    appends=_append_files(domain)
+    with _lock:
+        entry=_cache.get(domain)
+        if entry is not None and entry['stat']==stat and entry['appends']==appends:
+            return entry['data'],entry['version']
+        if entry is not None and entry['appends']==appends[:len(entry['appends'])]:
+            if entry['stat']!=stat and entry['hash']==_file_hash(path):
+                entry['stat']=stat
+            if entry['stat']==stat:
+                _apply(domain,entry,appends[len(entry['appends']):])
+                return entry['data'],entry['version']
+        digest=_file_hash(path)
+        entry={'stat':stat,'hash':digest,'version':digest,'rows':pq.ParquetFile(path).metadata.num_rows,'appends':appends,'lineage':{}}
+        for stamp in appends:
+            _advance(entry,stamp[0],pq.ParquetFile(stamp[0]).metadata.num_rows)
+        entry['data']=_attach(domain,entry['version'])
+        if entry['data'] is None:
+            frames=[_read(domain,path)]+[_read(domain,stamp[0]) for stamp in appends]
+            entry['data']=_share(domain,entry['version'],concat(frames) if len(frames)>1 else frames[0])
+        _cache[domain]=entry
+        return entry['data'],entry['version']
+
+
+## Rows appended since the newest version in `known` that `version` was derived from, as (that version, rows),
+## or (None, None) when `version` is not the current one or none of its ancestors is known
+def appended_since(domain,version,known):
+    with _lock:
+        entry=_cache.get(domain)
+        if entry is None or entry['version']!=version:
+            return None,None
+        while version in entry['lineage']:
+            version,start=entry['lineage'][version]
+            if version in known:
+                return version,entry['data'].iloc[start:]
+    return None,None
+
+
+def partitioned(domain):
+    return os.path.isdir(os.path.join(DATASET_DIR,domain))
+
+
+## Hive partitioning of a domain, every partition value is a string so inferring types from the directory names
+## never turns a study such as 1001 into a number the filters cannot compare
+def partitioning(domain):
+    return ds.partitioning(pa.schema([(col,pa.string()) for col in PARTITIONS[domain]]),flavor='hive')
+
+
+def studies():
+    root=os.path.join(DATASET_DIR,'adsl')
+    return sorted(unquote(name.split('=',1)[1]) for name in os.listdir(root) if name.startswith('STUDYID='))
+
+
+## Files of the partitions matching `filters`, the leading partition columns are resolved to a directory
+## and the remaining ones are matched against the partition directories below it
+def _partition_files(domain,filters):
+    path=os.path.join(DATASET_DIR,domain)
+    segments=[]
+    for col in PARTITIONS[domain]:
+        if col not in filters:
+            continue
+        segment=f'{col}={quote(str(filters[col]),safe="")}'
+        if len(segments)==PARTITIONS[domain].index(col):
+            path=os.path.join(path,segment)
+        segments.append(segment)
+    files=glob.glob(os.path.join(path,'**','*.parquet'),recursive=True)
+    return sorted(f for f in files if all(seg in f.split(os.sep) for seg in segments))
+
+
+## Reads only the partitions and row groups matching `filters` (column=value) from the partitioned dataset.
+## Selections are cached per filter set and re-read when any of their files changes.
+def load_partition(domain,**filters):
+    key=(domain,)+tuple(sorted(filters.items()))
+    files=_partition_files(domain,filters)
+    stamp=tuple((path,)+_stat(path) for path in files)
+    with _lock:
+        entry=_partitions.get(key)
+        if entry is not None and entry['stamp']==stamp:
+            _partitions.move_to_end(key)
+            return entry['data'],entry['version']
+    if files:
+        expr=None
+        for col,value in filters.items():
+            expr=ds.field(col)==value if expr is None else expr & (ds.field(col)==value)
+        dataset=ds.dataset(files,format='parquet',partitioning=partitioning(domain),partition_base_dir=os.path.join(DATASET_DIR,domain))
+        data=normalize(dataset.to_table(columns=COLUMNS[domain],filter=expr).to_pandas())
+    else:
+        data=pd.DataFrame(columns=COLUMNS[domain])
+    digest=hashlib.sha256(repr((key,stamp)).encode()).hexdigest()[:16]
+    with _lock:
+        _partitions[key]={'stamp':stamp,'version':digest,'data':data}
+        _partitions.move_to_end(key)
+        while len(_partitions)>MAX_PARTITIONS:
+            _partitions.popitem(last=False)
+    return data,digest
+
+
+## (frame, version) for a domain. With a partitioned dataset only the study and partitions in `filters` are read,
+## with the flat files the whole file is returned, so callers still filter the rows they need themselves.
+def select(domain,study=None,**filters):
+    with metrics.timed('load',domain):
+        if not partitioned(domain):
+            return load(domain)
+        if study is not None:
+            filters['STUDYID']=study
+        return load_partition(domain,**filters)
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+        _partitions.clear()
@@ -0,0 +1,138 @@
+import argparse
+import html
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from plotly.offline import get_plotlyjs
+
+import ae_summary
+import charts
+import data_loader
+import lab_summary
+from charts import param_dict
+from warmup import TREATMENTS
+
+## Plot types of the Laboratory tab, 1 is the mean value, 2 the absolute and 3 the percent change from baseline
+PLOT_TYPES={1:'mean',2:'absolute_change',3:'percent_change'}
+
+ADSL_VARIABLES=('RACE','ETHNIC','DCDECOD')
+ADSL_CHARACTERISTICS=('BMIBL','WEIGHTBL','HEIGHTBL')
+
+## Data each worker holds, set once per process by `_init` instead of being sent with every figure
+_data={}
+
+
+## (section, builder, data name, args) of every figure the dashboard can show
+def jobs(box_points=False):
+    out=[]
+    for group in TREATMENTS:
+        for variable in ADSL_VARIABLES:
+            out.append(('adsl',charts.create_disposition_donut_plot,'adsl',(variable,group)))
+        for characteristic in ADSL_CHARACTERISTICS:
+            out.append(('adsl',charts.create_distribution_plot,'adsl',(characteristic,group)))
+        out.append(('adsl',charts.create_subject_count_bar_plot,'adsl',(group,)))
+    for param in param_dict.values():
+        section=f'lab/{param}'
+        out.append((section,charts.param_trend,'lab',(param,)))
+        out.append((section,charts.pre_post,'lab',(param,)))
+        for abs in (2,3):
+            out.append((section,charts.line_with_range,'lab',(param,abs)))
+        for group in TREATMENTS:
+            out.append((section,charts.box_treatment_summary,'adlb',(param,group)))
+            if box_points:
+                out.append((section,charts.box_treatment,'adlb',(param,group)))
+            out.append((section,charts.faceted_trend,'lab',(param,group)))
+            for abs in (2,3):
+                out.append((section,charts.line_with_sd,'lab',(param,abs,group)))
+    for basis in ae_summary.BASES:
+        out.append(('ae',charts.ae_hospitalisation,'ae',(basis,)))
+    for group in (None,)+TREATMENTS:
+        out.append(('ae',charts.ae_mean_duration,'ae',(group,)))
+        for basis in ae_summary.BASES:
+            for builder in (charts.ae_occurrences,charts.ae_outcome,charts.ae_severity,charts.ae_causality):
+                out.append(('ae',builder,'ae',(group,basis)))
+    return out
+
+
+## File name of a figure without extension, e.g. line_with_sd-HGB-percent_change-Placebo
+def stem(builder,args):
+    parts=[builder.__name__]
+    for arg in args:
+        if builder in (charts.line_with_range,charts.line_with_sd) and arg in PLOT_TYPES:
+            arg=PLOT_TYPES[arg]
+        parts.append('all' if arg is None else re.sub(r'[^A-Za-z0-9]+','_',str(arg)).strip('_'))
+    return '-'.join(parts)
+
+
+def _init(data):
+    _data.update(data)
+
+
+## Runs in a worker: builds one figure and writes it in every format, returns the written paths relative to `out_dir`
+def _export(section,builder,name,args,out_dir,formats):
+    fig=builder(_data[name],*args)
+    directory=os.path.join(out_dir,section)
+    os.makedirs(directory,exist_ok=True)
+    base=os.path.join(directory,stem(builder,args))
+    written=[]
+    for fmt in formats:
+        path=f'{base}.{fmt}'
+        if fmt=='html':
+            ## Every page loads the single plotly.min.js at the root of the export
+            fig.write_html(path,include_plotlyjs=os.path.relpath(os.path.join(out_dir,'plotly.min.js'),directory))
+        elif fmt=='json':
+            fig.write_json(path)
+        else:
+            fig.write_image(path)
+        written.append(os.path.relpath(path,out_dir))
+    return written
+
+
+def _index(out_dir,pages):
+    items=''.join(f'<li><a href="{html.escape(page)}">{html.escape(page)}</a></li>\n' for page in sorted(pages))
+    with open(os.path.join(out_dir,'index.html'),'w') as f:
+        f.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Dashboard figures</title></head>\n<body><ul>\n{items}</ul></body></html>\n')
+
+
+## Builds the summaries once, then renders every figure in `workers` processes and writes them to `out_dir`
+def export(out_dir,formats=('html','json'),workers=None,study=None,box_points=False):
+    start=time.perf_counter()
+    df_adsl,_=data_loader.select('adsl',study=study)
+    df_adlb,adlb_version=data_loader.select('adlb',study=study)
+    df_adae,adae_version=data_loader.select('adae',study=study)
+    data={'adsl':df_adsl,'adlb':df_adlb,'lab':lab_summary.get(df_adlb,adlb_version),'ae':ae_summary.get(df_adae,adae_version)}
+    os.makedirs(out_dir,exist_ok=True)
+    if 'html' in formats:
+        with open(os.path.join(out_dir,'plotly.min.js'),'w') as f:
+            f.write(get_plotlyjs())
+    todo=jobs(box_points)
+    manifest=[]
+    with ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context('spawn'),initializer=_init,initargs=(data,)) as pool:
+        futures=[pool.submit(_export,section,builder,name,args,out_dir,formats) for section,builder,name,args in todo]
+        for (section,builder,name,args),future in zip(todo,futures):
+            manifest.append({'section':section,'builder':builder.__name__,'args':list(args),'files':future.result()})
+    with open(os.path.join(out_dir,'manifest.json'),'w') as f:
+        json.dump(manifest,f,indent=2)
+    if 'html' in formats:
+        _index(out_dir,[path for entry in manifest for path in entry['files'] if path.endswith('.html')])
+    print(f'{len(manifest)} figures written to {out_dir} in {time.perf_counter()-start:.1f}s')
+    return manifest
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Write every dashboard figure, for every parameter, treatment and plot type, without Streamlit.')
+    parser.add_argument('out',help='directory the figures are written to')
+    parser.add_argument('--format',dest='formats',nargs='+',default=['html','json'],
+                        help='html, json and/or an image format such as png or svg (images need the kaleido package)')
+    parser.add_argument('--workers',type=int,help='worker processes, defaults to the number of cores')
+    parser.add_argument('--study',help='STUDYID to export when the partitioned datasets are used, defaults to the first one')
+    parser.add_argument('--box-points',action='store_true',help='also write the box plots with every AVAL point')
+    args=parser.parse_args()
+    study=args.study
+    if study is None and data_loader.partitioned('adsl'):
+        study=data_loader.studies()[0]
+    export(args.out,args.formats,args.workers,study,args.box_points)
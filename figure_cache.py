@@ -0,0 +1,200 @@
+import json
+import multiprocessing
+import multiprocessing.context
+import multiprocessing.spawn as spawn
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import plotly.graph_objs as go
+import plotly.io as pio
+
+import metrics
+
+DEFAULT_MAX_MB=float(os.environ.get('DASHBOARD_FIGURE_CACHE_MB','256'))
+
+## Worker processes that build the figures of one view in parallel, 0 builds them one after another on the calling thread
+WORKERS=int(os.environ.get('DASHBOARD_WORKERS','0'))
+
+_pool=None
+_pool_lock=threading.Lock()
+
+
+## Spawned workers run the parent's __main__ module first, under streamlit that is the dashboard script itself, and
+## streamlit assigns sys.modules['__main__'] at the start of every rerun, from any session's thread. Instead of swapping
+## that module, the workers of the pool are started with preparation data that leaves the main module out, so they
+## only import what the jobs need.
+def _preparation_data(name):
+    data=_get_preparation_data(name)
+    data.pop('init_main_from_path',None)
+    data.pop('init_main_from_name',None)
+    return data
+
+
+_get_preparation_data=spawn.get_preparation_data
+_spawn_lock=threading.Lock()
+
+
+## multiprocessing reads spawn.get_preparation_data when it starts a process, it is replaced only while one
+## of the pool's workers starts
+class _WorkerProcess(multiprocessing.context.SpawnProcess):
+
+    @staticmethod
+    def _Popen(process_obj):
+        with _spawn_lock:
+            spawn.get_preparation_data=_preparation_data
+            try:
+                return multiprocessing.context.SpawnProcess._Popen(process_obj)
+            finally:
+                spawn.get_preparation_data=_get_preparation_data
+
+
+class _WorkerContext(multiprocessing.context.SpawnContext):
+    Process=_WorkerProcess
+
+
+## Submits a job to the shared worker pool, started on first use. Workers are spawned, forking the threaded server
+## is not safe.
+def _submit(func,*args):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            template=pio.templates[pio.templates.default].to_plotly_json()
+            _pool=ProcessPoolExecutor(max_workers=WORKERS,mp_context=_WorkerContext(),
+                                      initializer=_init_worker,initargs=(template,))
+        return _pool.submit(func,*args)
+
+
+## Workers get the parent's default plotly template, e.g. the one streamlit registers when it is imported,
+## plotly express bakes its colors into the traces
+def _init_worker(template):
+    pio.templates['dashboard']=go.layout.Template(template)
+    pio.templates.default='dashboard'
+
+
+## Runs in a worker: builds one figure and returns its JSON with the build and serialization times
+def _build_json(builder,args):
+    start=time.perf_counter()
+    fig=builder(*args)
+    built=time.perf_counter()
+    fig_json=fig.to_json()
+    return fig_json,built-start,time.perf_counter()-built
+
+
+## Figure of a cached JSON string. The JSON was written by plotly from a validated figure, so it is wrapped without
+## validating it again; pio.from_json, or handing st.plotly_chart the plain dict, re-validates every trace (~20 ms a figure).
+def _decode(fig_json):
+    return go.Figure(json.loads(fig_json),_validate=False)
+
+
+## Process-wide LRU cache of serialized figures, shared by every session of the server.
+## Figures are stored as plotly JSON and the cache is bounded by the total size of those strings.
+class FigureCache:
+
+    def __init__(self,max_bytes=int(DEFAULT_MAX_MB*1024*1024)):
+        self.max_bytes=max_bytes
+        self._entries=OrderedDict()
+        self._size=0
+        self._lock=threading.Lock()
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    ## Serialized figure for `key`, or None on a miss
+    def get_json(self,key):
+        with self._lock:
+            fig_json=self._entries.get(key)
+            if fig_json is None:
+                self.misses+=1
+                return None
+            self._entries.move_to_end(key)
+            self.hits+=1
+            return fig_json
+
+    def put_json(self,key,fig_json):
+        size=len(fig_json)
+        with self._lock:
+            if key in self._entries:
+                self._size-=len(self._entries.pop(key))
+            if size>self.max_bytes:
+                return
+            self._entries[key]=fig_json
+            self._size+=size
+            while self._size>self.max_bytes:
+                _,evicted=self._entries.popitem(last=False)
+                self._size-=len(evicted)
+                self.evictions+=1
+
+    ## Returns the cached figure for `key`, calling `build()` and storing its JSON on a miss.
+    ## Building, serializing and decoding are timed as stages of chart `label`.
+    def get_or_build(self,key,build,label=None):
+        fig_json=self.get_json(key)
+        if fig_json is None:
+            with metrics.timed('build',label):
+                fig=build()
+            with metrics.timed('serialize',label):
+                fig_json=fig.to_json()
+            self.put_json(key,fig_json)
+        with metrics.timed('deserialize',label):
+            return _decode(fig_json)
+
+    ## Figures of independent (key, builder, args, label) jobs in job order. With WORKERS set and more than one miss,
+    ## the missing figures are built and serialized in the worker pool at the same time, with the arguments
+    ## `payload(builder,args)` reduces them to.
+    def get_or_build_many(self,jobs,payload=None):
+        found={}
+        missing={}
+        for key,builder,args,label in jobs:
+            if key in found or key in missing:
+                continue
+            fig_json=self.get_json(key)
+            if fig_json is None:
+                missing[key]=(builder,args,label)
+            else:
+                found[key]=fig_json
+        if WORKERS and len(missing)>1:
+            futures={key:_submit(_build_json,builder,payload(builder,args) if payload else args) for key,(builder,args,_) in missing.items()}
+            for key,future in futures.items():
+                fig_json,build_seconds,serialize_seconds=future.result()
+                metrics.record('build',missing[key][2],build_seconds)
+                metrics.record('serialize',missing[key][2],serialize_seconds)
+                self.put_json(key,fig_json)
+                found[key]=fig_json
+        else:
+            for key,(builder,args,label) in missing.items():
+                with metrics.timed('build',label):
+                    fig=builder(*args)
+                with metrics.timed('serialize',label):
+                    found[key]=fig.to_json()
+                self.put_json(key,found[key])
+        figs=[]
+        for key,_,_,label in jobs:
+            with metrics.timed('deserialize',label):
+                figs.append(_decode(found[key]))
+        return figs
+
+    def resize(self,max_bytes):
+        with self._lock:
+            self.max_bytes=max_bytes
+            while self._entries and self._size>self.max_bytes:
+                _,evicted=self._entries.popitem(last=False)
+                self._size-=len(evicted)
+                self.evictions+=1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size=0
+
+    def stats(self):
+        with self._lock:
+            lookups=self.hits+self.misses
+            return {'entries':len(self._entries),'bytes':self._size,'max_bytes':self.max_bytes,
+                    'hits':self.hits,'misses':self.misses,'evictions':self.evictions,
+                    'hit_rate':self.hits/lookups if lookups else 0.0}
+
+
+cache=FigureCache()
+metrics.register('figure_cache',cache.stats)
@@ -0,0 +1,49 @@
+import argparse
+import os
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import data_loader
+
+## Sort order inside each partition, keeps the row-group min/max statistics tight for the columns filtered on
+SORT_KEYS={'adsl':['USUBJID'],'adlb':['VISIT','USUBJID'],'adae':['AEBODSYS','USUBJID']}
+
+ROWS_PER_GROUP=64*1024
+
+
+## Writes one domain of a study as a hive-partitioned parquet dataset, replacing that study's existing partitions.
+## With `append` the records are added as new files next to the existing ones, only the partitions they land in are read again.
+def write_domain(domain,source,out_dir,append=False):
+    data=pd.read_parquet(source)
+    data=data.sort_values(data_loader.PARTITIONS[domain]+SORT_KEYS[domain],kind='stable')
+    table=pa.Table.from_pandas(data,preserve_index=False)
+    options={'existing_data_behavior':'overwrite_or_ignore','basename_template':f'append-{time.time_ns()}-{{i}}.parquet'} if append else \
+            {'existing_data_behavior':'delete_matching'}
+    ds.write_dataset(table,os.path.join(out_dir,domain),format='parquet',partitioning=data_loader.partitioning(domain),
+                     file_options=ds.ParquetFileFormat().make_write_options(compression='zstd',write_statistics=True),
+                     max_rows_per_group=ROWS_PER_GROUP,**options)
+    return len(data)
+
+
+def ingest(sources,out_dir,append=False):
+    for source in sources:
+        for domain,name in data_loader.FILES.items():
+            path=os.path.join(source,name)
+            if append and not os.path.exists(path):
+                continue
+            rows=write_domain(domain,path,out_dir,append)
+            print(f'{source}: {domain} {rows} rows')
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Write the ADaM parquet files of one or more studies as partitioned datasets.')
+    parser.add_argument('sources',nargs='*',default=[data_loader.DATA_DIR],
+                        help='directories holding adsl_final.parquet, adlb_final.parquet and adae_final.parquet')
+    parser.add_argument('--out',default=data_loader.DATASET_DIR,help='root of the partitioned datasets')
+    parser.add_argument('--append',action='store_true',
+                        help='add the records to the existing datasets, e.g. a daily delta holding only adlb_final.parquet')
+    args=parser.parse_args()
+    ingest(args.sources,args.out,args.append)
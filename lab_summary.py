@@ -0,0 +1,143 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import data_loader
+import metrics
+
+MEASURES=['AVAL','ABSVAL','PCTVAL']
+
+## Finest grain of the cube, every lab chart is a roll-up of these keys
+KEYS=['TRTA','VISIT','AVISIT','PARAMCD','LBNRIND','ABLFL']
+
+## Mean/standard deviation column names each chart expects per measure
+STAT_NAMES={'AVAL':('AVAL','ASTD'),'ABSVAL':('ABSVAL','ABSSTD'),'PCTVAL':('PCTVAL','PCTSTD')}
+
+## Summaries kept in memory, one per dataset version or, with partitioned datasets, per loaded parameter
+MAX_SUMMARIES=16
+
+_summaries=OrderedDict()
+_lock=threading.Lock()
+
+
+## n, sum and sum of squares of every measure per cube cell
+def build_cube(data):
+    data=data[KEYS+MEASURES].copy()
+    aggs={}
+    for m in MEASURES:
+        ## Sums of squares need double precision even when a measure is stored as float32
+        data[m]=data[m].astype('float64')
+        data[f'{m}_SQ']=data[m]**2
+        aggs[f'{m}_N']=(m,'count')
+        aggs[f'{m}_SUM']=(m,'sum')
+        aggs[f'{m}_SS']=(f'{m}_SQ','sum')
+    return data.groupby(by=KEYS,observed=True,dropna=False).agg(**aggs).reset_index()
+
+
+## Adds the cells of two cubes, n, sums and sums of squares of the same cell simply add up
+def merge_cubes(cube,other):
+    merged=data_loader.concat([cube,other])
+    return merged.groupby(by=KEYS,observed=True,dropna=False).sum().reset_index()
+
+
+## Distinct subjects of every cube cell, unique subject counts cannot be added up but these sets can be merged
+def subject_keys(data):
+    return data[KEYS+['USUBJID']].drop_duplicates(ignore_index=True)
+
+
+## Combines cube cells into mean/std per group, matching pandas' mean() and std(ddof=1)
+def rollup(cube,keys,measure):
+    mean_name,std_name=STAT_NAMES[measure]
+    grouped=cube.groupby(by=keys,observed=True)[[f'{measure}_N',f'{measure}_SUM',f'{measure}_SS']].sum()
+    n=grouped[f'{measure}_N'].astype('float64')
+    total=grouped[f'{measure}_SUM']
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mean=total/n
+        var=((grouped[f'{measure}_SS']-total*mean)/(n-1)).clip(lower=0)
+    out=pd.DataFrame({mean_name:mean.where(n>0),std_name:np.sqrt(var).where(n>1)})
+    return out.reset_index()
+
+
+## Unique subject counts per lab indicator
+def indicator_counts(subjects):
+    return subjects.groupby(by=['TRTA','AVISIT','PARAMCD','LBNRIND'],observed=True)['USUBJID'].nunique().reset_index()
+
+
+def _split(table):
+    return {param:frame.reset_index(drop=True) for param,frame in table.groupby('PARAMCD',observed=True)}
+
+
+def _tables(cube,subjects):
+    post=cube[cube['ABLFL']=='N']
+    return {'pre_post':rollup(cube,['TRTA','AVISIT','PARAMCD'],'AVAL').drop(columns='ASTD'),
+            'trend':rollup(cube,['TRTA','VISIT','PARAMCD'],'AVAL'),
+            'abs_change':rollup(cube,['TRTA','VISIT','PARAMCD'],'ABSVAL'),
+            'pct_change':rollup(cube,['TRTA','VISIT','PARAMCD'],'PCTVAL'),
+            'abs_change_post':rollup(post,['TRTA','VISIT','PARAMCD'],'ABSVAL'),
+            'pct_change_post':rollup(post,['TRTA','VISIT','PARAMCD'],'PCTVAL'),
+            'lab_indicator':indicator_counts(subjects)}
+
+
+class LabSummary:
+
+    ## Summary of `data` at dataset `version`. With `previous`, `data` only holds the records appended since
+    ## that summary and just the parameters they touch are rolled up again.
+    def __init__(self,data,version=None,previous=None):
+        cube=build_cube(data)
+        subjects=subject_keys(data)
+        self.version=version
+        if previous is None:
+            self.cube,self.subjects=cube,subjects
+            self.views,self.versions={},{}
+        else:
+            params=list(cube['PARAMCD'].unique())
+            touched=previous.cube['PARAMCD'].isin(params)
+            cube=merge_cubes(previous.cube[touched],cube)
+            subjects=data_loader.concat([previous.subjects[previous.subjects['PARAMCD'].isin(params)],subjects]).drop_duplicates(ignore_index=True)
+            self.cube=data_loader.concat([previous.cube[~touched],cube])
+            self.subjects=data_loader.concat([previous.subjects[~previous.subjects['PARAMCD'].isin(params)],subjects])
+            self.views={param:views for param,views in previous.views.items() if param not in params}
+            self.versions={param:stamp for param,stamp in previous.versions.items() if param not in params}
+        tables=_tables(cube,subjects)
+        self.columns={name:table.columns for name,table in tables.items()}
+        for name,table in tables.items():
+            for param,frame in _split(table).items():
+                self.views.setdefault(param,{})[name]=frame
+                self.versions[param]=version
+
+    ## Summary table `name` for one PARAMCD, an empty frame when the parameter has no rows
+    def view(self,param,name):
+        frame=self.views.get(param,{}).get(name)
+        if frame is None:
+            return pd.DataFrame(columns=self.columns[name])
+        return frame
+
+    ## Copy with only the views of `param`, without the cube and subject sets, small enough to send to a worker process
+    def subset(self,param):
+        part=LabSummary.__new__(LabSummary)
+        part.version,part.columns=self.version,self.columns
+        part.cube,part.subjects=self.cube.iloc[:0],self.subjects.iloc[:0]
+        part.views={param:self.views[param]} if param in self.views else {}
+        part.versions={param:self.versions[param]} if param in self.versions else {}
+        return part
+
+    ## Dataset version in which the rows of `param` last changed, figures of the parameter are cached under it
+    def param_version(self,param):
+        return self.versions.get(param,self.version)
+
+
+## Returns the summary for a dataset version, building it only the first time the version is seen.
+## A version produced by appending records to a known one is updated from that summary with only the new rows.
+def get(data,version):
+    with _lock,metrics.timed('aggregate','lab'):
+        summary=_summaries.get(version)
+        if summary is None:
+            parent,delta=data_loader.appended_since('adlb',version,_summaries)
+            summary=LabSummary(delta,version,_summaries[parent]) if parent else LabSummary(data,version)
+            _summaries[version]=summary
+            while len(_summaries)>MAX_SUMMARIES:
+                _summaries.popitem(last=False)
+        _summaries.move_to_end(version)
+        return summary
@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger=logging.getLogger(__name__)
+
+## Prometheus text-format file rewritten after every rerun, e.g. for the node_exporter textfile collector
+METRICS_FILE=os.environ.get('DASHBOARD_METRICS_FILE')
+
+## File the JSON line of every rerun is appended to, '-' for stderr. streamlit run leaves logging unconfigured,
+## so without it the records only reach handlers an embedding process set up itself.
+METRICS_LOG=os.environ.get('DASHBOARD_METRICS_LOG')
+if METRICS_LOG and not logger.handlers:
+    _handler=logging.StreamHandler() if METRICS_LOG=='-' else logging.FileHandler(METRICS_LOG)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate=False
+
+## Shows the timing panel in the dashboard sidebar
+ADMIN=os.environ.get('DASHBOARD_ADMIN')=='1'
+
+_local=threading.local()
+_totals={}
+_reruns={'count':0,'seconds':0.0}
+_collectors={}
+_lock=threading.Lock()
+
+
+## Starts the timing record of one script rerun in the calling thread
+def begin(page):
+    _local.rerun={'page':page,'started':time.time(),'seconds':None,'stages':[]}
+    _local.start=time.perf_counter()
+
+
+## Times the enclosed block as `stage` ('load', 'aggregate', 'build', 'serialize', 'render', ...) of `chart`, the domain or builder name.
+## The time is added to the process totals and, inside a rerun, to that rerun's record.
+@contextmanager
+def timed(stage,chart=None):
+    start=time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage,chart,time.perf_counter()-start)
+
+
+## Adds a duration measured elsewhere, e.g. in a worker process, like `timed` does
+def record(stage,chart,seconds):
+    with _lock:
+        total=_totals.setdefault((stage,chart),{'count':0,'seconds':0.0})
+        total['count']+=1
+        total['seconds']+=seconds
+    rerun=getattr(_local,'rerun',None)
+    if rerun is not None:
+        rerun['stages'].append({'stage':stage,'chart':chart,'seconds':seconds})
+
+
+## Closes the current rerun, logs it as one JSON line and returns its record
+def end():
+    rerun=getattr(_local,'rerun',None)
+    if rerun is None:
+        return None
+    rerun['seconds']=time.perf_counter()-_local.start
+    _local.rerun=None
+    with _lock:
+        _reruns['count']+=1
+        _reruns['seconds']+=rerun['seconds']
+    logger.info(json.dumps(rerun))
+    if METRICS_FILE:
+        ## Sessions finish reruns concurrently, each writer needs its own temporary file
+        tmp=f'{METRICS_FILE}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp,'w') as f:
+            f.write(prometheus())
+        os.replace(tmp,METRICS_FILE)
+    return rerun
+
+
+## Adds the gauges returned by `stats()` (a dict of numbers) to the exported metrics as `dashboard_<name>_<key>`
+def register(name,stats):
+    _collectors[name]=stats
+
+
+def _labels(**labels):
+    return ','.join(f'{k}="{v}"' for k,v in labels.items() if v is not None)
+
+
+## All totals and registered gauges in the Prometheus text exposition format
+def prometheus():
+    lines=['# TYPE dashboard_stage_seconds summary']
+    with _lock:
+        totals=sorted(_totals.items(),key=lambda item:(item[0][0],item[0][1] or ''))
+        reruns=dict(_reruns)
+    for (stage,chart),total in totals:
+        labels=_labels(stage=stage,chart=chart)
+        lines.append(f'dashboard_stage_seconds_sum{{{labels}}} {total["seconds"]:.6f}')
+        lines.append(f'dashboard_stage_seconds_count{{{labels}}} {total["count"]}')
+    lines.append('# TYPE dashboard_rerun_seconds summary')
+    lines.append(f'dashboard_rerun_seconds_sum {reruns["seconds"]:.6f}')
+    lines.append(f'dashboard_rerun_seconds_count {reruns["count"]}')
+    for name,stats in sorted(_collectors.items()):
+        for key,value in stats().items():
+            lines.append(f'# TYPE dashboard_{name}_{key} gauge')
+            lines.append(f'dashboard_{name}_{key} {value}')
+    return '\n'.join(lines)+'\n'
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import ae_summary
+import charts
+import data_loader
+import lab_summary
+from charts import param_dict
+
+logger=logging.getLogger(__name__)
+
+TREATMENTS=('Placebo', 'Xanomeline High Dose', 'Xanomeline Low Dose')
+
+## Written once warm-up has finished so an orchestrator can use it as a readiness probe
+READY_FILE=os.environ.get('DASHBOARD_READY_FILE')
+
+_status={'state':'idle','started':None,'finished':None,'figures':0,'error':None}
+_lock=threading.Lock()
+
+
+## Loads and normalizes every dataset, builds the lab and AE summaries and renders the figures
+## each tab shows with its default selections, for every treatment, into the shared figure cache
+def warm_up():
+    study=data_loader.studies()[0] if data_loader.partitioned('adsl') else None
+    param=next(iter(param_dict.values()))
+    figures=0
+
+    df_adsl,adsl_version=data_loader.select('adsl',study=study)
+    df_adlb,adlb_version=data_loader.select('adlb',study=study,PARAMCD=param)
+    lab=lab_summary.get(df_adlb,adlb_version)
+    df_adae,adae_version=data_loader.select('adae',study=study)
+    ae=ae_summary.get(df_adae,adae_version)
+
+    lab_version=lab.param_version(param)
+    charts.cached_figure(charts.param_trend,lab_version,lab,param)
+    charts.cached_figure(charts.pre_post,lab_version,lab,param)
+    charts.cached_figure(charts.ae_hospitalisation,ae.group_version(),ae,'events')
+    figures+=3
+    for group in (None,)+TREATMENTS:
+        charts.cached_figure(charts.ae_mean_duration,ae.group_version(group),ae,group)
+        for builder in (charts.ae_occurrences,charts.ae_outcome,charts.ae_severity,charts.ae_causality):
+            charts.cached_figure(builder,ae.group_version(group),ae,group,'events')
+        figures+=5
+    for group in TREATMENTS:
+        charts.cached_figure(charts.create_disposition_donut_plot,adsl_version,df_adsl,'RACE',group)
+        charts.cached_figure(charts.create_distribution_plot,adsl_version,df_adsl,'BMIBL',group)
+        charts.cached_figure(charts.create_subject_count_bar_plot,adsl_version,df_adsl,group)
+        ## Keyed like the dashboard keys the box plot
+        if data_loader.partitioned('adlb'):
+            df_box,box_version=data_loader.select('adlb',study=study,TRTA=group,PARAMCD=param)
+        else:
+            df_box,box_version=df_adlb,lab_version
+        charts.cached_figure(charts.box_treatment_summary,box_version,df_box,param,group)
+        charts.cached_figure(charts.faceted_trend,lab_version,lab,param,group)
+        figures+=5
+    return figures
+
+
+def _run():
+    try:
+        figures=warm_up()
+    except Exception as exc:
+        logger.exception('Dashboard warm-up failed')
+        with _lock:
+            _status.update(state='failed',finished=time.time(),error=repr(exc))
+        return
+    with _lock:
+        _status.update(state='ready',finished=time.time(),figures=figures)
+        logger.info('Dashboard warm-up finished in %.1fs, %d figures',_status['finished']-_status['started'],figures)
+        if READY_FILE:
+            with open(READY_FILE,'w') as f:
+                json.dump(_status,f)
+
+
+## Starts the warm-up in a background thread, only the first call of a process does anything
+def start():
+    with _lock:
+        if _status['state']!='idle':
+            return
+        _status.update(state='running',started=time.time())
+        if READY_FILE and os.path.exists(READY_FILE):
+            os.remove(READY_FILE)
+    threading.Thread(target=_run,name='dashboard-warmup',daemon=True).start()
+
+
+def status():
+    with _lock:
+        return dict(_status)
+
+
+def is_ready():
+    return status()['state']=='ready'
+
+
+## Starts the warm-up and the Streamlit server in the same process, so the server shares the warmed caches.
+## Server options are read from .streamlit/config.toml or STREAMLIT_* environment variables, e.g. STREAMLIT_SERVER_PORT.
+## The dashboard imports `warmup`, the state of this `__main__` copy of the module would not be shared with it.
+if __name__=='__main__':
+    from streamlit.web import bootstrap
+
+    import warmup
+
+    logging.basicConfig(level=logging.INFO)
+    warmup.start()
+    script=os.path.join(os.path.dirname(os.path.abspath(__file__)),'combinded_dashboard.py')
+    bootstrap.load_config_options(flag_options={})
+    bootstrap.run(script,False,[],{})